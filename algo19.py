@@ -2,13 +2,16 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import re
-import base64
+import hashlib
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import BytesIO
 import logging
-import openpyxl
-from openpyxl.styles import Alignment, Border, Side, Font
 from datetime import datetime
 
+from expiry_utils import parse_symbol_expiry
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +24,188 @@ except ImportError:
     st.error("Streamlit is not installed. Please install it using `pip install streamlit`.")
     st.stop()
 
+# Settled position frames kept per (positions, bhavcopies, expiries, settlement flags)
+SETTLEMENT_CACHE_SIZE = 4
+# Generated download files kept per content digest
+DOWNLOAD_CACHE_SIZE = 8
+GRIDLOG_CHUNK_ROWS = 100_000
+
+
+# ===================== PNL ENGINE =====================
+# Module level (not nested in run) so the multi-date batch workers can pickle and import it
+def load_bhavcopies(nfo_bhav_file, bfo_bhav_file):
+    """Parse each uploaded bhavcopy once into an (Expiry, Strike) -> Settlement_Price table."""
+    logger.info("Loading bhavcopies")
+    try:
+        bhav = {"nfo": None, "bfo": None}
+        if nfo_bhav_file:
+            df_bhav_nfo = pd.read_csv(nfo_bhav_file)
+            df_bhav_nfo["Date"] = df_bhav_nfo["CONTRACT_D"].str.extract(r'(\d{2}-[A-Z]{3}-\d{4})')
+            df_bhav_nfo["Symbol"] = df_bhav_nfo["CONTRACT_D"].str.extract(r'^(.*?)(\d{2}-[A-Z]{3}-\d{4})')[0]
+            df_bhav_nfo["Strike_Type"] = df_bhav_nfo["CONTRACT_D"].str.extract(r'(PE\d+|CE\d+)$')
+            df_bhav_nfo["Date"] = pd.to_datetime(df_bhav_nfo["Date"], format="%d-%b-%Y")
+            df_bhav_nfo["Strike_Type"] = df_bhav_nfo["Strike_Type"].str.replace(r'^(PE|CE)(\d+)$', r'\2\1', regex=True)
+            # Every NIFTY option expiry is kept; positions join on (expiry, strike, CE/PE)
+            df_bhav_nfo = df_bhav_nfo[df_bhav_nfo["Symbol"] == "OPTIDXNIFTY"]
+            bhav["nfo"] = (
+                df_bhav_nfo[["Date", "Strike_Type", "SETTLEMENT"]]
+                .drop_duplicates(subset=["Date", "Strike_Type"], keep="last")
+                .rename(columns={"Date": "Expiry", "Strike_Type": "Strike", "SETTLEMENT": "Settlement_Price"})
+            )
+        if bfo_bhav_file:
+            df_bhav_bfo = pd.read_csv(bfo_bhav_file)
+            df_bhav_bfo["Expiry Date"] = pd.to_datetime(df_bhav_bfo["Expiry Date"], format="%d %b %Y", errors="coerce")
+            df_bhav_bfo["Symbols"] = df_bhav_bfo["Series Code"].astype(str).str[-7:]
+            bhav["bfo"] = (
+                df_bhav_bfo.drop_duplicates(["Expiry Date", "Symbols"])[["Expiry Date", "Symbols", "Close Price"]]
+                .rename(columns={"Expiry Date": "Expiry", "Symbols": "Strike", "Close Price": "Settlement_Price"})
+            )
+        return bhav
+    except Exception as e:
+        logger.error(f"Error in load_bhavcopies: {e}")
+        raise
+
+def settle_positions(df, bhav, expiry_nfo, expiry_bfo):
+    """Realized and settlement PNL for every position row of the file in one vectorized pass."""
+    logger.info("Starting PNL data processing")
+    try:
+        required_columns = ['Exchange', 'Symbol', 'Net Qty', 'Buy Avg Price', 'Sell Avg Price',
+                            'Sell Qty', 'Buy Qty', 'Realized Profit', 'Unrealized Profit']
+        missing = [c for c in required_columns if c not in df.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {missing}")
+
+        df = df.copy()
+        # The raw symbol still carries the expiry; it is gone once reduced to strike + CE/PE
+        raw_symbol = df["Symbol"].astype(str)
+        df["Symbol"] = (
+            df["Symbol"]
+            .astype(str)
+            .str.upper()
+            .str.replace(" ", "", regex=False)   # remove spaces
+            .str.extract(r'(\d{5}(PE|CE)|((PE|CE)\d{5}))', expand=False)
+            .iloc[:, 0]
+            .str.replace(r'(PE|CE)(\d{5})', r'\2\1', regex=True)
+        )
+
+        df["Calculated_Realized_PNL"] = np.select(
+            [df["Net Qty"] == 0, df["Net Qty"] > 0, df["Net Qty"] < 0],
+            [(df["Sell Avg Price"] - df["Buy Avg Price"]) * df["Sell Qty"],
+             (df["Sell Avg Price"] - df["Buy Avg Price"]) * df["Sell Qty"],
+             (df["Sell Avg Price"] - df["Buy Avg Price"]) * df["Buy Qty"]],
+            default=0)
+
+        df["Expiry"] = pd.NaT
+        df["Settlement_Price"] = np.nan
+        for exchange, prices, default_expiry in (("NFO", bhav["nfo"], expiry_nfo), ("BFO", bhav["bfo"], expiry_bfo)):
+            if prices is None:
+                continue
+            mask = df["Exchange"] == exchange
+            expiry = parse_symbol_expiry(raw_symbol[mask], prices["Expiry"]).fillna(pd.to_datetime(default_expiry))
+            strike = df.loc[mask, "Symbol"].astype(str).str.strip()
+            price = pd.MultiIndex.from_arrays([expiry, strike]).map(prices.set_index(["Expiry", "Strike"])["Settlement_Price"])
+            df.loc[mask, "Expiry"] = expiry
+            df.loc[mask, "Settlement_Price"] = np.asarray(price, dtype=float)
+
+        df["Calculated_Settlement_PNL"] = np.select(
+            [df["Net Qty"] > 0, df["Net Qty"] < 0],
+            [(df["Settlement_Price"] - df["Buy Avg Price"]) * df["Net Qty"].abs(),
+             (df["Sell Avg Price"] - df["Settlement_Price"]) * df["Net Qty"].abs()],
+            default=0)
+        return df
+    except Exception as e:
+        logger.error(f"Error in settle_positions: {e}")
+        raise
+
+def summarize_by_user(settled, users):
+    """NFO/BFO realized and settlement totals for every user from a single groupby."""
+    pnl_cols = ["Calculated_Realized_PNL", "Calculated_Settlement_PNL"]
+    totals = (
+        settled[settled["Exchange"].isin(["NFO", "BFO"])]
+        .groupby(["UserID", "Exchange"])[pnl_cols].sum()
+        .unstack("Exchange")
+        .reindex(index=users, columns=pd.MultiIndex.from_product([pnl_cols, ["NFO", "BFO"]]))
+        .fillna(0)
+    )
+    summary_df = pd.DataFrame({
+        "UserID": users,
+        "NFO Realized": totals[("Calculated_Realized_PNL", "NFO")].to_numpy(),
+        "NFO Settlement": totals[("Calculated_Settlement_PNL", "NFO")].to_numpy(),
+        "BFO Realized": totals[("Calculated_Realized_PNL", "BFO")].to_numpy(),
+        "BFO Settlement": totals[("Calculated_Settlement_PNL", "BFO")].to_numpy(),
+    })
+    summary_df["Total Realized"] = summary_df["NFO Realized"] + summary_df["BFO Realized"]
+    summary_df["Total Settlement"] = summary_df["NFO Settlement"] + summary_df["BFO Settlement"]
+    summary_df["Grand Total"] = summary_df["Total Realized"] + summary_df["Total Settlement"]
+    return summary_df
+
+
+def settle_day(day, positions_path, nfo_bhav_path, bfo_bhav_path):
+    """Batch worker: per-user realized/settlement totals for one trading day read from local files."""
+    positions = pd.read_csv(positions_path)
+    bhav = load_bhavcopies(nfo_bhav_path, bfo_bhav_path)
+    # Symbols without an encoded expiry fall back to that day's nearest listed expiry
+    fallbacks = []
+    for prices in (bhav["nfo"], bhav["bfo"]):
+        upcoming = prices["Expiry"][prices["Expiry"] >= day] if prices is not None else pd.Series(dtype="datetime64[ns]")
+        fallbacks.append(upcoming.min() if not upcoming.empty else pd.NaT)
+    settled = settle_positions(positions, bhav, *fallbacks)
+    summary_df = summarize_by_user(settled, positions["UserID"].unique())
+    summary_df.insert(0, "Date", day)
+    return summary_df
+
+
+FILE_DATE_PATTERNS = [
+    (r'(?i)(?<![a-z])op(\d{2})(\d{2})(\d{2})(?!\d)', "%d %m %y"),  # NSE option bhavcopy op220825.csv
+    (r'(\d{1,2})[\s_-]*([A-Za-z]{3})[\s_-]*(\d{4})', "%d %b %Y"),  # 22 AUG 2025, 22AUG2025
+    (r'(\d{4})-?(\d{2})-?(\d{2})', "%Y %m %d"),                     # 20250822, 2025-08-22
+    (r'(\d{2})-?(\d{2})-?(\d{4})', "%d %m %Y"),                     # 22082025, 22-08-2025
+]
+
+def file_date(file_name):
+    """Trading date in a file name, or None when no supported date pattern is found.
+
+    >>> file_date("op220825.csv") == file_date("positions_22AUG2025.csv") == pd.Timestamp("2025-08-22")
+    True
+    >>> file_date("BhavCopy_BSE_FO_0_0_0_20250822_F_0000.csv")
+    Timestamp('2025-08-22 00:00:00')
+    """
+    for pattern, fmt in FILE_DATE_PATTERNS:
+        for match in re.finditer(pattern, file_name):
+            parsed = pd.to_datetime(" ".join(match.groups()), format=fmt, errors="coerce")
+            if pd.notna(parsed) and 2000 <= parsed.year < 2100:
+                return parsed
+    return None
+
+def find_daily_files(directory):
+    """Pair the dated positions / NFO bhavcopy / BFO bhavcopy CSVs of a directory by trading date.
+
+    Files are told apart by their header (UserID + Net Qty, CONTRACT_D, Series Code); returns the
+    per-date table and the names that could not be paired.
+    """
+    days = {}
+    skipped = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.lower().endswith(".csv") or not os.path.isfile(path):
+            continue
+        day = file_date(name)
+        try:
+            cols = {str(c).strip() for c in pd.read_csv(path, nrows=0).columns}
+        except Exception:
+            cols = set()
+        kind = "positions" if {"UserID", "Net Qty"} <= cols else "nfo" if "CONTRACT_D" in cols else "bfo" if "Series Code" in cols else None
+        if day is None or kind is None:
+            skipped.append(name)
+            continue
+        entry = days.setdefault(day, {"Date": day, "positions": None, "nfo": None, "bfo": None})
+        if entry[kind] is not None:
+            skipped.append(name)
+            continue
+        entry[kind] = path
+    table = pd.DataFrame(list(days.values()), columns=["Date", "positions", "nfo", "bfo"]).sort_values("Date", ignore_index=True)
+    return table, skipped
+
 
 # ===================== MAIN RUN FUNCTION =====================
 def run():
@@ -139,108 +324,134 @@ def run():
 
     # ===================== ALL FUNCTIONS FIRST (EXACT SAME) =====================
 
-    def process_portfolio_data(gridlog_file, summary_file):
+    def normalize_times(values, dotted=False):
+        """Zero-padded HH:MM:SS found in each value (NaN if none); dotted=True also reads '15.20.00'."""
+        text = values.astype(str)
+        if dotted:
+            text = text.str.replace('.', ':', regex=False)
+        parts = text.str.extract(r'(\d{1,2}):(\d{2}):(\d{2})')
+        return parts[0].str.zfill(2) + ':' + parts[1] + ':' + parts[2]
+
+    def read_gridlog(gridlog_file):
+        """Stream the GridLog keeping only Combined SL / trail target rows.
+
+        Returns (matched rows, set of (portfolio, HH:MM:SS) seen anywhere in the log, set of portfolios).
+        """
+        grid_cols = ['Message', 'Option Portfolio', 'Timestamp']
+        usecols = lambda c: str(c).strip() in grid_cols
         if gridlog_file.name.endswith('.csv'):
-            df_grid = pd.read_csv(gridlog_file)
+            chunks = pd.read_csv(gridlog_file, usecols=usecols, chunksize=GRIDLOG_CHUNK_ROWS)
         elif gridlog_file.name.endswith('.xlsx'):
-            df_grid = pd.read_excel(gridlog_file)
+            chunks = [pd.read_excel(gridlog_file, usecols=usecols)]
         else:
             raise ValueError("Unsupported GridLog file type. Use CSV or Excel.")
 
-        df_grid.columns = df_grid.columns.str.strip()
+        matched = []
+        grid_index = set()
+        for chunk in chunks:
+            chunk.columns = chunk.columns.str.strip()
+            missing = [c for c in grid_cols if c not in chunk.columns]
+            if missing:
+                raise ValueError(f"GridLog is missing columns: {missing}")
+            mask = chunk['Message'].astype(str).str.contains(r'Combined SL:|Combined trail target:', case=False, na=False)
+            matched.append(chunk.loc[mask, grid_cols])
+            rows = chunk[['Option Portfolio', 'Timestamp']].dropna(subset=['Option Portfolio'])
+            grid_index.update(zip(rows['Option Portfolio'], normalize_times(rows['Timestamp'])))
+            logger.info(f"GridLog chunk: {len(chunk)} rows, {int(mask.sum())} matched")
+
+        filtered_grid = pd.concat(matched, ignore_index=True) if matched else pd.DataFrame(columns=grid_cols)
+        grid_portfolios = {portfolio for portfolio, _ in grid_index}
+        return filtered_grid, grid_index, grid_portfolios
+
+    def join_unique_reasons(df, key, col, sort=False):
+        """', '-joined distinct values of col per key (first-seen order, or sorted), deduplicated on category codes."""
+        codes = df[col].astype('category').cat.codes
+        distinct = df.loc[~pd.DataFrame({'key': df[key], 'code': codes}).duplicated(), [key, col]]
+        if sort:
+            distinct = distinct.sort_values([key, col], kind='mergesort')
+        return distinct.groupby(key)[col].agg(', '.join)
 
-        mask = df_grid['Message'].str.contains(r'Combined SL:|Combined trail target:', case=False, na=False)
-        filtered_grid = df_grid.loc[mask, ['Message', 'Option Portfolio', 'Timestamp']].dropna(subset=['Option Portfolio'])
+    def process_portfolio_data(gridlog_file, summary_file):
+        filtered_grid, grid_index, grid_portfolios = read_gridlog(gridlog_file)
+        filtered_grid = filtered_grid.dropna(subset=['Option Portfolio'])
 
         filtered_grid['MessageType'] = filtered_grid['Message'].str.extract(r'(Combined SL|Combined trail target)', flags=re.IGNORECASE)
         duplicate_mask = filtered_grid.duplicated(subset=['Option Portfolio', 'MessageType'], keep=False)
         filtered_grid = filtered_grid[duplicate_mask]
 
-        summary_grid = (
-            filtered_grid.groupby('Option Portfolio').agg({
-                'Message': lambda x: ', '.join(x.unique()),
-                'Timestamp': 'max'
-            }).reset_index()
-            .rename(columns={'Message': 'Reason', 'Timestamp': 'Time'})
-        )
+        summary_grid = pd.concat([
+            join_unique_reasons(filtered_grid, 'Option Portfolio', 'Message'),
+            filtered_grid.groupby('Option Portfolio')['Timestamp'].max()
+        ], axis=1).reset_index().rename(columns={'Message': 'Reason', 'Timestamp': 'Time'})
 
+        # Parse every legs sheet once; both the OnSqOffTime and the AllLegsCompleted passes reuse them
         xl = pd.ExcelFile(summary_file)
-        summary_list = []
-
+        legs_sheets = []
         for sheet_name in xl.sheet_names:
             if "legs" in sheet_name.lower():
                 df_leg = xl.parse(sheet_name)
                 df_leg.columns = df_leg.columns.str.strip()
-
-                if {'Exit Type', 'Portfolio Name', 'Exit Time'}.issubset(df_leg.columns):
-                    onsqoff_df = df_leg[df_leg['Exit Type'].astype(str).str.strip() == 'OnSqOffTime']
-                    if not onsqoff_df.empty:
-                        grouped = onsqoff_df.groupby('Portfolio Name')['Exit Time'].max().reset_index()
-                        for _, row in grouped.iterrows():
-                            summary_list.append({
-                                'Option Portfolio': row['Portfolio Name'],
-                                'Reason': 'OnSqOffTime',
-                                'Time': row['Exit Time']
-                            })
-
-        summary_summary = pd.DataFrame(summary_list)
+                legs_sheets.append(df_leg)
+
+        summary_parts = []
+        for df_leg in legs_sheets:
+            if {'Exit Type', 'Portfolio Name', 'Exit Time'}.issubset(df_leg.columns):
+                onsqoff_df = df_leg[df_leg['Exit Type'].astype(str).str.strip() == 'OnSqOffTime']
+                if not onsqoff_df.empty:
+                    grouped = onsqoff_df.groupby('Portfolio Name')['Exit Time'].max().reset_index()
+                    summary_parts.append(pd.DataFrame({
+                        'Option Portfolio': grouped['Portfolio Name'],
+                        'Reason': 'OnSqOffTime',
+                        'Time': grouped['Exit Time']
+                    }))
+
+        summary_summary = pd.concat(summary_parts, ignore_index=True) if summary_parts else pd.DataFrame()
         final_df = pd.concat([summary_grid, summary_summary], ignore_index=True)
-        final_df = final_df.groupby('Option Portfolio').agg({
-            'Reason': lambda x: ', '.join(sorted(set(x))),
-            'Time': 'last'
-        }).reset_index()
+        final_df = pd.concat([
+            join_unique_reasons(final_df, 'Option Portfolio', 'Reason', sort=True),
+            final_df.groupby('Option Portfolio')['Time'].last()
+        ], axis=1).reset_index()
 
-        completed_list = []
-        grid_portfolios = df_grid['Option Portfolio'].dropna().unique()
+        # grid_index is the (portfolio, HH:MM:SS) hash index from read_gridlog, so each exit time is an O(1) lookup
+        reported = set(final_df['Option Portfolio'])
 
-        for sheet_name in xl.sheet_names:
-            if "legs" in sheet_name.lower():
-                df_leg = xl.parse(sheet_name)
-                df_leg.columns = df_leg.columns.str.strip()
-
-                if 'Portfolio Name' in df_leg.columns and 'Status' in df_leg.columns:
-                    for portfolio, group in df_leg.groupby('Portfolio Name'):
-                        if (portfolio not in final_df['Option Portfolio'].values 
-                            and portfolio in grid_portfolios):
-                            statuses = group['Status'].astype(str).str.strip().unique()
-                            if len(statuses) == 1 and statuses[0].lower() == 'completed':
-                                reason_text = 'AllLegsCompleted'
-                                exit_time_to_use = None
-                                if 'Exit Time' in group.columns:
-                                    for exit_time, exit_type in zip(group['Exit Time'], group.get('Exit Type', [])):
-                                        if pd.isna(exit_time):
-                                            continue
-                                        normalized_exit_time = str(exit_time).replace('.', ':').strip()
-                                        matching_rows = df_grid[
-                                            (df_grid['Option Portfolio'] == portfolio) &
-                                            (df_grid['Timestamp'].astype(str).str.contains(normalized_exit_time))
-                                        ]
-                                        if not matching_rows.empty:
-                                            reason_text += f", {exit_type.strip()}"
-                                            exit_time_to_use = exit_time
-                                            break
-                                completed_list.append({
-                                    'Option Portfolio': portfolio,
-                                    'Reason': reason_text,
-                                    'Time': exit_time_to_use
-                                })
+        completed_list = []
+        for df_leg in legs_sheets:
+            if 'Portfolio Name' in df_leg.columns and 'Status' in df_leg.columns:
+                exit_tokens = normalize_times(df_leg['Exit Time'], dotted=True) if 'Exit Time' in df_leg.columns else None
+                for portfolio, group in df_leg.groupby('Portfolio Name'):
+                    if portfolio not in reported and portfolio in grid_portfolios:
+                        statuses = group['Status'].astype(str).str.strip().unique()
+                        if len(statuses) == 1 and statuses[0].lower() == 'completed':
+                            reason_text = 'AllLegsCompleted'
+                            exit_time_to_use = None
+                            if exit_tokens is not None:
+                                for exit_time, exit_type, token in zip(group['Exit Time'], group.get('Exit Type', []), exit_tokens[group.index]):
+                                    if pd.isna(exit_time) or pd.isna(token):
+                                        continue
+                                    if (portfolio, token) in grid_index:
+                                        reason_text += f", {exit_type.strip()}"
+                                        exit_time_to_use = exit_time
+                                        break
+                            completed_list.append({
+                                'Option Portfolio': portfolio,
+                                'Reason': reason_text,
+                                'Time': exit_time_to_use
+                            })
 
         if completed_list:
             completed_df = pd.DataFrame(completed_list)
             final_df = pd.concat([final_df, completed_df], ignore_index=True)
 
-        def clean_reason(text):
-            if pd.isna(text):
-                return text
-            text = str(text)
-            match = re.search(r'(Combined SL: [^ ]+ hit|Combined Trail Target: [^ ]+ hit)', text, re.IGNORECASE)
-            if match:
-                return match.group(1)
-            if 'AllLegsCompleted' in text:
-                text = text.replace('AllLegsCompleted,', '').replace('AllLegsCompleted', '').strip()
-            return text.strip()
-
-        final_df['Reason'] = final_df['Reason'].apply(clean_reason)
+        # The first "Combined SL/Trail Target: X hit" wins; otherwise drop the AllLegsCompleted marker
+        hit = final_df['Reason'].str.extract(r'(Combined SL: [^ ]+ hit|Combined Trail Target: [^ ]+ hit)', flags=re.IGNORECASE)[0]
+        rest = (
+            final_df['Reason']
+            .str.replace('AllLegsCompleted,', '', regex=False)
+            .str.replace('AllLegsCompleted', '', regex=False)
+            .str.strip()
+        )
+        final_df['Reason'] = hit.fillna(rest)
 
         filename = gridlog_file.name
         match = re.search(r'(\d{1,2}\s+[A-Za-z]{3}\s+\d{4})', filename)
@@ -255,119 +466,117 @@ def run():
         final_df['Time'] = final_df['Time'].astype(str).str.strip().replace('nan', None)
         return final_df, output_filename
 
-    def process_data(df, nfo_bhav_file, bfo_bhav_file, expiry_nfo, expiry_bfo,
-                     include_settlement_nfo, include_settlement_bfo):
-        logger.info("Starting PNL data processing")
-        try:
-            required_columns = ['Exchange', 'Symbol', 'Net Qty', 'Buy Avg Price', 'Sell Avg Price',
-                                'Sell Qty', 'Buy Qty', 'Realized Profit', 'Unrealized Profit']
-            missing = [c for c in required_columns if c not in df.columns]
-            if missing:
-                raise ValueError(f"Missing columns: {missing}")
-
-            df["Symbol"] = (
-                df["Symbol"]
-                .astype(str)
-                .str.upper()
-                .str.replace(" ", "", regex=False)   # remove spaces
-                .str.extract(r'(\d{5}(PE|CE)|((PE|CE)\d{5}))', expand=False)
-                .iloc[:, 0]
-                .str.replace(r'(PE|CE)(\d{5})', r'\2\1', regex=True)
-            )
+    def process_data(summary_df, user):
+        """Metric-card totals for one user, read from the all-users summary."""
+        row = summary_df.set_index("UserID").loc[user]
+        return {
+            "total_realized_nfo": row["NFO Realized"],
+            "total_settlement_nfo": row["NFO Settlement"],
+            "total_realized_bfo": row["BFO Realized"],
+            "total_settlement_bfo": row["BFO Settlement"],
+            "overall_realized": row["Total Realized"],
+            "overall_settlement": row["Total Settlement"],
+            "grand_total": row["Grand Total"]
+        }
+
+    def file_digest(uploaded_file):
+        """SHA-256 of an uploaded file's bytes (None when nothing is uploaded)."""
+        return hashlib.sha256(uploaded_file.getvalue()).hexdigest() if uploaded_file else None
+
+    def partition_by_user(df):
+        """Stable-sort positions by UserID and index each user's [start, stop) row range."""
+        ordered = df.sort_values("UserID", kind="mergesort").reset_index(drop=True)
+        sizes = ordered.groupby("UserID", sort=False).size()
+        stops = sizes.cumsum().to_numpy()
+        offsets = dict(zip(sizes.index, zip((stops - sizes.to_numpy()).tolist(), stops.tolist())))
+        return ordered, offsets
+
+    def get_settlement(nfo_bhav_file, bfo_bhav_file, expiry_nfo, expiry_bfo, include_settlement_nfo, include_settlement_bfo):
+        """Settled positions and all-users summary, computed once per (bhavcopies, expiries, flags) for this upload."""
+        nfo_bhav_file = nfo_bhav_file if include_settlement_nfo else None
+        bfo_bhav_file = bfo_bhav_file if include_settlement_bfo else None
+        key = (
+            st.session_state.positions_digest,
+            file_digest(nfo_bhav_file), expiry_nfo if nfo_bhav_file else None,
+            file_digest(bfo_bhav_file), expiry_bfo if bfo_bhav_file else None
+        )
+        cache = st.session_state.settlement_cache
+        if key not in cache:
+            bhav = load_bhavcopies(nfo_bhav_file, bfo_bhav_file)
+            settled_df = settle_positions(st.session_state.positions_df, bhav, expiry_nfo, expiry_bfo)
+            cache[key] = {"settled": settled_df, "summary": summarize_by_user(settled_df, st.session_state.positions_users)}
+            while len(cache) > SETTLEMENT_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+        else:
+            logger.info("Settlement cache hit")
+        return cache[key]
 
-            df_nfo = df[df["Exchange"] == "NFO"].copy()
-            df_bfo = df[df["Exchange"] == "BFO"].copy()
-
-            total_realized_nfo = total_realized_bfo = 0
-            total_settlement_nfo = total_settlement_bfo = 0
-
-            cond_nfo = [df_nfo["Net Qty"] == 0, df_nfo["Net Qty"] > 0, df_nfo["Net Qty"] < 0]
-            choice_nfo = [
-                (df_nfo["Sell Avg Price"] - df_nfo["Buy Avg Price"]) * df_nfo["Sell Qty"],
-                (df_nfo["Sell Avg Price"] - df_nfo["Buy Avg Price"]) * df_nfo["Sell Qty"],
-                (df_nfo["Sell Avg Price"] - df_nfo["Buy Avg Price"]) * df_nfo["Buy Qty"]
-            ]
-            df_nfo["Calculated_Realized_PNL"] = np.select(cond_nfo, choice_nfo, default=0)
-            total_realized_nfo = df_nfo["Calculated_Realized_PNL"].fillna(0).sum()
-
-            cond_bfo = [df_bfo["Net Qty"] == 0, df_bfo["Net Qty"] > 0, df_bfo["Net Qty"] < 0]
-            choice_bfo = [
-                (df_bfo["Sell Avg Price"] - df_bfo["Buy Avg Price"]) * df_bfo["Sell Qty"],
-                (df_bfo["Sell Avg Price"] - df_bfo["Buy Avg Price"]) * df_bfo["Sell Qty"],
-                (df_bfo["Sell Avg Price"] - df_bfo["Buy Avg Price"]) * df_bfo["Buy Qty"]
-            ]
-            df_bfo["Calculated_Realized_PNL"] = np.select(cond_bfo, choice_bfo, default=0)
-            total_realized_bfo = df_bfo["Calculated_Realized_PNL"].fillna(0).sum()
-
-            if include_settlement_nfo and nfo_bhav_file:
-                df_bhav_nfo = pd.read_csv(nfo_bhav_file)
-                df_bhav_nfo["Date"] = df_bhav_nfo["CONTRACT_D"].str.extract(r'(\d{2}-[A-Z]{3}-\d{4})')
-                df_bhav_nfo["Symbol"] = df_bhav_nfo["CONTRACT_D"].str.extract(r'^(.*?)(\d{2}-[A-Z]{3}-\d{4})')[0]
-                df_bhav_nfo["Strike_Type"] = df_bhav_nfo["CONTRACT_D"].str.extract(r'(PE\d+|CE\d+)$')
-                df_bhav_nfo["Date"] = pd.to_datetime(df_bhav_nfo["Date"], format="%d-%b-%Y")
-                df_bhav_nfo["Strike_Type"] = df_bhav_nfo["Strike_Type"].str.replace(r'^(PE|CE)(\d+)$', r'\2\1', regex=True)
-                df_bhav_nfo = df_bhav_nfo[(df_bhav_nfo["Date"] == pd.to_datetime(expiry_nfo)) & (df_bhav_nfo["Symbol"] == "OPTIDXNIFTY")]
-                df_nfo["Strike_Type"] = df_nfo["Symbol"].str.extract(r'(\d+[A-Z]{2})$')
-                df_nfo = df_nfo.merge(df_bhav_nfo[["Strike_Type", "SETTLEMENT"]], on="Strike_Type", how="left")
-                df_nfo["Calculated_Settlement_PNL"] = np.select(
-                    [df_nfo["Net Qty"] > 0, df_nfo["Net Qty"] < 0],
-                    [(df_nfo["SETTLEMENT"] - df_nfo["Buy Avg Price"]) * abs(df_nfo["Net Qty"]),
-                     (df_nfo["Sell Avg Price"] - df_nfo["SETTLEMENT"]) * abs(df_nfo["Net Qty"])],
-                    default=0)
-                total_settlement_nfo = df_nfo["Calculated_Settlement_PNL"].fillna(0).sum()
-
-            if include_settlement_bfo and bfo_bhav_file:
-                df_bhav_bfo = pd.read_csv(bfo_bhav_file)
-                df_bhav_bfo["Expiry Date"] = pd.to_datetime(df_bhav_bfo["Expiry Date"], format="%d %b %Y", errors="coerce")
-                df_bhav_bfo = df_bhav_bfo[df_bhav_bfo["Expiry Date"] == pd.to_datetime(expiry_bfo)]
-                df_bhav_bfo["Symbols"] = df_bhav_bfo["Series Code"].astype(str).str[-7:]
-                mapping = df_bhav_bfo.drop_duplicates("Symbols").set_index("Symbols")["Close Price"]
-                df_bfo["Close Price"] = df_bfo["Symbol"].astype(str).str.strip().map(mapping)
-                df_bfo["Calculated_Settlement_PNL"] = 0
-                df_bfo.loc[df_bfo["Net Qty"] > 0, "Calculated_Settlement_PNL"] = (df_bfo["Close Price"] - df_bfo["Buy Avg Price"]) * df_bfo["Net Qty"].abs()
-                df_bfo.loc[df_bfo["Net Qty"] < 0, "Calculated_Settlement_PNL"] = (df_bfo["Sell Avg Price"] - df_bfo["Close Price"]) * df_bfo["Net Qty"].abs()
-                total_settlement_bfo = df_bfo["Calculated_Settlement_PNL"].fillna(0).sum()
-
-            overall_realized = total_realized_nfo + total_realized_bfo
-            overall_settlement = total_settlement_nfo + total_settlement_bfo
-            grand_total = overall_realized + overall_settlement
-
-            return {
-                "total_realized_nfo": total_realized_nfo,
-                "total_settlement_nfo": total_settlement_nfo,
-                "total_realized_bfo": total_realized_bfo,
-                "total_settlement_bfo": total_settlement_bfo,
-                "overall_realized": overall_realized,
-                "overall_settlement": overall_settlement,
-                "grand_total": grand_total
-            }
-        except Exception as e:
-            logger.error(f"Error in process_data: {e}")
-            raise
-
-    def get_excel_download_link(df, filename):
+    def get_excel_bytes(df, sheet_name='PNL Data'):
+        """Styled workbook streamed row by row with one shared header format and one format per column."""
         output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='PNL Data')
-            ws = writer.sheets['PNL Data']
-            for row in ws.rows:
-                for cell in row:
-                    cell.alignment = Alignment(horizontal='center')
-                    cell.border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                                         top=Side(style='thin'), bottom=Side(style='thin'))
-            for cell in ws[1]:
-                cell.font = Font(bold=True, color="FFFFFF")
-                cell.fill = openpyxl.styles.PatternFill(start_color="4F81BD", fill_type="solid")
-        b64 = base64.b64encode(output.getvalue()).decode()
-        return f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="{filename}.xlsx">Download {filename}.xlsx</a>'
-
-    def get_csv_download_link(df, filename):
-        csv = df.to_csv(index=False).encode()
-        b64 = base64.b64encode(csv).decode()
-        return f'<a href="data:text/csv;base64,{b64}" download="{filename}">Download {filename}</a>'
+        with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}}) as writer:
+            workbook = writer.book
+            ws = workbook.add_worksheet(sheet_name)
+            border = {'border': 1, 'align': 'center'}
+            header_fmt = workbook.add_format({**border, 'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#4F81BD'})
+            cell_fmt = workbook.add_format(border)
+            datetime_fmt = workbook.add_format({**border, 'num_format': 'yyyy-mm-dd hh:mm:ss'})
+            col_fmts = [datetime_fmt if pd.api.types.is_datetime64_any_dtype(df[col]) else cell_fmt for col in df.columns]
+
+            ws.write_row(0, 0, [str(col) for col in df.columns], header_fmt)
+            values = df.astype(object).where(df.notna(), None)
+            for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+                for c, value in enumerate(row):
+                    ws.write(r, c, value, col_fmts[c])
+        return output.getvalue()
+
+    def get_csv_bytes(df):
+        return df.to_csv(index=False).encode()
+
+    def cached_download_bytes(df, kind, build):
+        """File bytes for a frame, built once per (kind, content) and reused across reruns."""
+        digest = hashlib.sha256(
+            pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes() + repr(list(df.columns)).encode()
+        ).hexdigest()
+        cache = st.session_state.setdefault("download_cache", {})
+        key = (kind, digest)
+        if key not in cache:
+            cache[key] = build(df)
+            while len(cache) > DOWNLOAD_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+        return cache[key]
+
+    def excel_download_button(df, filename, key, label=None, build=get_excel_bytes):
+        st.download_button(
+            label=label or f"Download {filename}.xlsx",
+            data=cached_download_bytes(df, f"xlsx:{build.__name__}", build),
+            file_name=f"{filename}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key=key
+        )
+
+    def csv_download_button(df, filename, key):
+        st.download_button(
+            label=f"Download {filename}",
+            data=cached_download_bytes(df, "csv", get_csv_bytes),
+            file_name=filename,
+            mime="text/csv",
+            key=key
+        )
+
+    def get_batch_excel_bytes(series):
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            series.to_excel(writer, index=False, sheet_name='Daily PNL')
+            for sheet_name, col in (('Grand Total', 'Grand Total'), ('Realized', 'Total Realized'), ('Settlement', 'Total Settlement')):
+                pivot = series.pivot_table(index='UserID', columns='Date', values=col, aggfunc='sum', fill_value=0)
+                pivot.columns = [d.strftime('%d-%m-%Y') for d in pivot.columns]
+                pivot['Total'] = pivot.sum(axis=1)
+                pivot.reset_index().to_excel(writer, index=False, sheet_name=sheet_name)
+        return output.getvalue()
 
     # ===================== TABS =====================
-    tab1, tab2 = st.tabs(["Full PNL Calculation", "Portfolio Exit Analysis"])
+    tab1, tab2, tab3 = st.tabs(["Full PNL Calculation", "Portfolio Exit Analysis", "Multi-Date Batch"])
 
    # ===================== TAB 1: PNL CALCULATION =====================
     with tab1:
@@ -380,8 +589,16 @@ def run():
             selected_user = None
             if positions_file:
                 if 'positions_df' not in st.session_state or st.session_state.get('positions_file_name') != positions_file.name:
-                    st.session_state.positions_df = pd.read_csv(positions_file)
+                    positions_df = pd.read_csv(positions_file)
                     st.session_state.positions_file_name = positions_file.name
+                    st.session_state.positions_digest = file_digest(positions_file)
+                    st.session_state.settlement_cache = {}
+                    if 'UserID' in positions_df.columns:
+                        # Partition once per upload: users keep file order for the summary,
+                        # rows are grouped so one user's positions are a single slice
+                        st.session_state.positions_users = positions_df['UserID'].unique()
+                        positions_df, st.session_state.positions_offsets = partition_by_user(positions_df)
+                    st.session_state.positions_df = positions_df
                 df = st.session_state.positions_df
                 if 'UserID' in df.columns:
                     users = sorted(df['UserID'].unique().tolist())
@@ -413,114 +630,132 @@ def run():
                 expiry_bfo = st.date_input("BFO Expiry Date", value=datetime.now().date(), key="bfo_expiry", disabled=not include_settlement_bfo)
            
             process_button = st.button("Process Data", key="process_button")
-
             if process_button:
+                st.session_state.pop("pnl_result", None)
                 if positions_file and selected_user:
                     if (include_settlement_nfo and not nfo_bhav_file) or (include_settlement_bfo and not bfo_bhav_file):
                         st.error("Please upload all required files.")
                     else:
                         try:
                             with st.spinner("Processing PNL..."):
-                                filtered_df = st.session_state.positions_df[st.session_state.positions_df['UserID'] == selected_user]
-                                results = process_data(
-                                    filtered_df, nfo_bhav_file, bfo_bhav_file,
-                                    expiry_nfo, expiry_bfo,
+                                # Bhavcopies and symbols are parsed once for the whole file; the
+                                # selected user and the all-users summary both read from it
+                                df_all = st.session_state.positions_df
+                                settlement = get_settlement(
+                                    nfo_bhav_file, bfo_bhav_file, expiry_nfo, expiry_bfo,
                                     include_settlement_nfo, include_settlement_bfo
                                 )
+                                settled_df, summary_df = settlement["settled"], settlement["summary"]
+                                results = process_data(summary_df, selected_user)
+                                start, stop = st.session_state.positions_offsets[selected_user]
+                                filtered_df = settled_df.iloc[start:stop][df_all.columns]
+
+                            st.session_state.pnl_result = {
+                                "positions_digest": st.session_state.positions_digest,
+                                "user": selected_user,
+                                "results": results,
+                                "filtered": filtered_df,
+                                "summary": summary_df,
+                            }
 
                             st.success("PNL processed successfully!")
 
-                            # ==================== DISPLAY RESULTS WITH METRIC CARDS ====================
-                            col1, col2, col3, col4 = st.columns(4)
-                            with col1:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">NFO Realized PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['total_realized_nfo'] >= 0 else '#ef4444'}">
-                                        ₹{results['total_realized_nfo']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-                            with col2:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">NFO Settlement PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['total_settlement_nfo'] >= 0 else '#ef4444'}">
-                                        ₹{results['total_settlement_nfo']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-                            with col3:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">BFO Realized PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['total_realized_bfo'] >= 0 else '#ef4444'}">
-                                        ₹{results['total_realized_bfo']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-                            with col4:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">BFO Settlement PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['total_settlement_bfo'] >= 0 else '#ef4444'}">
-                                        ₹{results['total_settlement_bfo']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-
-                            # Overall Summary
-                            st.markdown("### Overall Summary")
-                            colA, colB, colC = st.columns(3)
-                            with colA:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">Total Realized PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['overall_realized'] >= 0 else '#ef4444'}; font-size: 2rem;">
-                                        ₹{results['overall_realized']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-                            with colB:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">Total Settlement PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['overall_settlement'] >= 0 else '#ef4444'}; font-size: 2rem;">
-                                        ₹{results['overall_settlement']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-                            with colC:
-                                st.markdown(f"""
-                                <div class="metric-card">
-                                    <div class="metric-label">Grand Total PNL</div>
-                                    <div class="metric-value" style="color: {'#10b981' if results['grand_total'] >= 0 else '#ef4444'}; font-size: 2.5rem;">
-                                        ₹{results['grand_total']:,.2f}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-
-                            # ==================== DOWNLOAD FILTERED DATA ====================
-                            st.markdown("### Download Processed Positions Data")
-                            download_df = filtered_df.copy()
-                            csv_link = get_csv_download_link(download_df, f"PNL_{selected_user}_{datetime.now().strftime('%Y%m%d')}.csv")
-                            excel_link = get_excel_download_link(download_df, f"PNL_{selected_user}_{datetime.now().strftime('%Y%m%d')}")
-
-                            col_d1, col_d2 = st.columns(2)
-                            with col_d1:
-                                st.markdown(csv_link, unsafe_allow_html=True)
-                            with col_d2:
-                                st.markdown(excel_link, unsafe_allow_html=True)
-
                         except Exception as e:
                             st.error(f"Error during processing: {e}")
                             logger.error(f"Processing error: {e}", exc_info=True)
                 else:
                     st.error("Please upload positions file and select a user.")
 
-        # ===================== ALL USERS SUMMARY (B2: file-only, pointer resets) =====================
-        # This section runs ONLY after process_button click and only if positions_file exists
-        if process_button and positions_file:
+            # Results live in session state so a download click (which reruns the page)
+            # keeps the cards, tables and the other download buttons on screen
+            pnl_result = st.session_state.get("pnl_result")
+            if pnl_result is not None and (not positions_file or pnl_result["positions_digest"] != st.session_state.positions_digest or pnl_result["user"] != selected_user):
+                pnl_result = None
+            if pnl_result is not None:
+                results = pnl_result["results"]
+
+                # ==================== DISPLAY RESULTS WITH METRIC CARDS ====================
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">NFO Realized PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['total_realized_nfo'] >= 0 else '#ef4444'}">
+                            ₹{results['total_realized_nfo']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                with col2:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">NFO Settlement PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['total_settlement_nfo'] >= 0 else '#ef4444'}">
+                            ₹{results['total_settlement_nfo']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                with col3:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">BFO Realized PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['total_realized_bfo'] >= 0 else '#ef4444'}">
+                            ₹{results['total_realized_bfo']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                with col4:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">BFO Settlement PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['total_settlement_bfo'] >= 0 else '#ef4444'}">
+                            ₹{results['total_settlement_bfo']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+
+                # Overall Summary
+                st.markdown("### Overall Summary")
+                colA, colB, colC = st.columns(3)
+                with colA:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">Total Realized PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['overall_realized'] >= 0 else '#ef4444'}; font-size: 2rem;">
+                            ₹{results['overall_realized']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                with colB:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">Total Settlement PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['overall_settlement'] >= 0 else '#ef4444'}; font-size: 2rem;">
+                            ₹{results['overall_settlement']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                with colC:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <div class="metric-label">Grand Total PNL</div>
+                        <div class="metric-value" style="color: {'#10b981' if results['grand_total'] >= 0 else '#ef4444'}; font-size: 2.5rem;">
+                            ₹{results['grand_total']:,.2f}
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+
+                # ==================== DOWNLOAD FILTERED DATA ====================
+                st.markdown("### Download Processed Positions Data")
+                download_df = pnl_result["filtered"]
+                col_d1, col_d2 = st.columns(2)
+                with col_d1:
+                    csv_download_button(download_df, f"PNL_{selected_user}_{datetime.now().strftime('%Y%m%d')}.csv", key="download_user_csv")
+                with col_d2:
+                    excel_download_button(download_df, f"PNL_{selected_user}_{datetime.now().strftime('%Y%m%d')}", key="download_user_excel")
+
+        # ===================== ALL USERS SUMMARY =====================
+        # This section runs after a process_button click and stays up while its result is kept
+        if positions_file and (process_button or pnl_result is not None):
             st.markdown("<hr>", unsafe_allow_html=True)
             st.markdown("## All Users Realized & Settlement Summary")
 
@@ -530,77 +765,30 @@ def run():
             if 'UserID' not in df_all.columns:
                 st.error("'UserID' column missing in positions file — cannot build summary.")
             else:
-                users = df_all['UserID'].unique()
-                summary_rows = []
-
-                # Check bhavcopy requirements BEFORE looping
+                # Check bhavcopy requirements BEFORE building the summary
                 if include_settlement_nfo and not nfo_bhav_file:
                     st.error("NFO settlement is enabled but NFO Bhavcopy file was not uploaded.")
                 elif include_settlement_bfo and not bfo_bhav_file:
                     st.error("BFO settlement is enabled but BFO Bhavcopy file was not uploaded.")
+                elif pnl_result is None:
+                    st.error("All users summary could not be built; see the error above.")
                 else:
-                    for user in users:
-                        temp_df = df_all[df_all["UserID"] == user].copy()
-
-                        # RESET pointer before EACH read (critical for B2)
-                        try:
-                            if include_settlement_nfo and nfo_bhav_file:
-                                nfo_bhav_file.seek(0)
-                        except Exception:
-                            pass
-
-                        try:
-                            if include_settlement_bfo and bfo_bhav_file:
-                                bfo_bhav_file.seek(0)
-                        except Exception:
-                            pass
-
-                        # Now safely call process_data()
-                        try:
-                            results = process_data(
-                                temp_df,
-                                nfo_bhav_file if include_settlement_nfo else None,
-                                bfo_bhav_file if include_settlement_bfo else None,
-                                expiry_nfo,
-                                expiry_bfo,
-                                include_settlement_nfo,
-                                include_settlement_bfo
-                            )
-                        except Exception as e:
-                            st.error(f"Error while calculating summary for user {user}: {e}")
-                            # continue to next user (don't break entire summary)
-                            continue
-
-                        summary_rows.append({
-                            "UserID": user,
-                            "NFO Realized": results.get("total_realized_nfo", 0),
-                            "NFO Settlement": results.get("total_settlement_nfo", 0),
-                            "BFO Realized": results.get("total_realized_bfo", 0),
-                            "BFO Settlement": results.get("total_settlement_bfo", 0),
-                            "Total Realized": results.get("overall_realized", 0),
-                            "Total Settlement": results.get("overall_settlement", 0),
-                            "Grand Total": results.get("grand_total", 0)
-                        })
-
-                    # Build DataFrame
-                    summary_df = pd.DataFrame(summary_rows)
+                    summary_df = pnl_result["summary"]
                     st.dataframe(summary_df)
 
                     # ====== EXCEL DOWNLOAD ======
-                    output = BytesIO()
-                    filename = f"A19_Realized&settlement_PNL_{datetime.now().strftime('%Y%m%d')}.xlsx"
-
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        summary_df.to_excel(writer, index=False, sheet_name='Summary')
-
-                    b64 = base64.b64encode(output.getvalue()).decode()
-                    download_link = (
-                        f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" '
-                        f'download="{filename}">📥 Download All Users Summary Excel</a>'
+                    def summary_excel_bytes(df):
+                        output = BytesIO()
+                        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                            df.to_excel(writer, index=False, sheet_name='Summary')
+                        return output.getvalue()
+
+                    excel_download_button(
+                        summary_df, f"A19_Realized&settlement_PNL_{datetime.now().strftime('%Y%m%d')}",
+                        key="download_all_users_summary", label="📥 Download All Users Summary Excel",
+                        build=summary_excel_bytes
                     )
 
-                    st.markdown(download_link, unsafe_allow_html=True)
-
     # ===================== TAB 2: PORTFOLIO ANALYSIS =====================
     with tab2:
         st.markdown('<hr class="my-8 border-gray-300">', unsafe_allow_html=True)
@@ -616,18 +804,98 @@ def run():
             summary_file = st.file_uploader("Summary Excel File", type="xlsx", key="summary_upload")
         
         if st.button("Process Portfolio Data", key="process_portfolio_button"):
+            st.session_state.pop("portfolio_result", None)
             if gridlog_file and summary_file:
                 try:
                     with st.spinner("Processing portfolio data..."):
                         final_df, output_filename = process_portfolio_data(gridlog_file, summary_file)
+                    st.session_state.portfolio_result = {"final": final_df, "file_name": output_filename}
                     st.success("Done!")
-                    st.write(final_df)
-                    st.markdown(get_csv_download_link(final_df, output_filename), unsafe_allow_html=True)
                 except Exception as e:
                     st.error(f"Error: {e}")
             else:
                 st.error("Please upload both files.")
 
+        portfolio_result = st.session_state.get("portfolio_result")
+        if portfolio_result is not None and gridlog_file and summary_file:
+            st.write(portfolio_result["final"])
+            csv_download_button(portfolio_result["final"], portfolio_result["file_name"], key="download_portfolio_csv")
+
+    # ===================== TAB 3: MULTI-DATE BATCH =====================
+    with tab3:
+        st.markdown('<h1 class="header-text">Multi-Date Batch</h1>', unsafe_allow_html=True)
+        st.markdown('<p class="subheader-text">Realized & settlement PNL for every user and every day found in a local folder.</p>', unsafe_allow_html=True)
+        st.info("Put the dated positions files and the NFO/BFO bhavcopies in one folder; files are paired by the date in their name and told apart by their columns. Symbols without an expiry settle at that day's nearest listed expiry.")
+
+        batch_dir = st.text_input("Folder path", key="batch_dir")
+        batch_col1, batch_col2 = st.columns(2)
+        with batch_col1:
+            batch_nfo = st.checkbox("Include Settlement PNL for NFO", value=True, key="batch_nfo_settlement")
+            batch_bfo = st.checkbox("Include Settlement PNL for BFO", value=True, key="batch_bfo_settlement")
+        with batch_col2:
+            batch_workers = st.number_input("Worker processes", min_value=1, max_value=max(1, os.cpu_count() or 1), value=min(4, os.cpu_count() or 1), step=1, key="batch_workers")
+            batch_format = st.radio("Output format", ["Excel", "Parquet"], horizontal=True, key="batch_format")
+
+        if st.button("Run Batch", key="batch_button"):
+            if not batch_dir or not os.path.isdir(batch_dir):
+                st.error("Folder not found.")
+            else:
+                days, skipped = find_daily_files(batch_dir)
+                if skipped:
+                    st.warning(f"Skipped {len(skipped)} file(s) with no date, unknown columns or a duplicate date: {', '.join(skipped)}")
+                jobs = []
+                for day in days.itertuples(index=False):
+                    missing = [name for name, needed, path in (("positions", True, day.positions), ("NFO bhavcopy", batch_nfo, day.nfo), ("BFO bhavcopy", batch_bfo, day.bfo)) if needed and path is None]
+                    if missing:
+                        st.warning(f"{day.Date:%d-%m-%Y}: missing {', '.join(missing)} — day skipped.")
+                        continue
+                    jobs.append((day.Date, day.positions, day.nfo if batch_nfo else None, day.bfo if batch_bfo else None))
+
+                if not jobs:
+                    st.error("No complete day found in the folder.")
+                else:
+                    results = []
+                    progress = st.progress(0.0, text=f"Processing {len(jobs)} day(s)...")
+                    # spawn: forking the threaded Streamlit server is not safe
+                    with ProcessPoolExecutor(max_workers=int(batch_workers), mp_context=multiprocessing.get_context("spawn")) as pool:
+                        futures = {pool.submit(settle_day, *job): job[0] for job in jobs}
+                        for done, future in enumerate(as_completed(futures), start=1):
+                            try:
+                                results.append(future.result())
+                            except Exception as e:
+                                st.error(f"{futures[future]:%d-%m-%Y}: {e}")
+                                logger.error(f"Batch day {futures[future]} failed: {e}", exc_info=True)
+                            progress.progress(done / len(jobs), text=f"Processed {done}/{len(jobs)} day(s)")
+
+                    if results:
+                        series = pd.concat(results, ignore_index=True).sort_values(["Date", "UserID"], ignore_index=True)
+                        stamp = f"{series['Date'].min():%Y%m%d}_{series['Date'].max():%Y%m%d}"
+                        if batch_format == "Parquet":
+                            try:
+                                data, file_name, mime = series.to_parquet(index=False), f"A19_batch_pnl_{stamp}.parquet", "application/octet-stream"
+                            except ImportError:
+                                st.error("Parquet output needs pyarrow or fastparquet; falling back to Excel.")
+                                data = None
+                        if batch_format != "Parquet" or data is None:
+                            data, file_name, mime = get_batch_excel_bytes(series), f"A19_batch_pnl_{stamp}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        st.session_state.batch_result = {"series": series, "data": data, "file_name": file_name, "mime": mime}
+
+        batch_result = st.session_state.get("batch_result")
+        if batch_result is not None:
+            series = batch_result["series"]
+            st.success(f"{series['Date'].nunique()} day(s), {series['UserID'].nunique()} user(s).")
+            grand = series.pivot_table(index='UserID', columns='Date', values='Grand Total', aggfunc='sum', fill_value=0)
+            grand.columns = [d.strftime('%d-%m-%Y') for d in grand.columns]
+            grand['Total'] = grand.sum(axis=1)
+            st.dataframe(grand, use_container_width=True)
+            st.download_button(
+                label=f"Download {batch_result['file_name']}",
+                data=batch_result["data"],
+                file_name=batch_result["file_name"],
+                mime=batch_result["mime"],
+                key="download_batch"
+            )
+
 # ===================== AUTO CALL run() =====================
 if __name__ == "__main__":
     st.write(f"DEBUG: Starting app at {datetime.now()}")
@@ -3,9 +3,17 @@ import pandas as pd
 import numpy as np
 from collections import deque
 from openpyxl import Workbook
+from typing import Dict, List, Optional, Tuple
 import io, time, uuid
+import os
 import time
 import uuid
+import hashlib
+import json
+import tracemalloc
+from datetime import datetime
+
+from expiry_utils import parse_symbol_expiry
 
 # IMPORTANT: To fix "AxiosError: Request failed with status code 403" for file uploads:
 # 1. Create a '.streamlit' folder in your project root (if not exists).
@@ -17,6 +25,439 @@ import uuid
 # 4. If deployed, run with: streamlit run dashboard.py --server.enableXsrfProtection=false --server.enableCORS=false
 # 5. Test with small files (<1MB) first. Update Streamlit: pip install --upgrade streamlit
 
+# -------------------- FIFO helpers --------------------
+ORDERBOOK_REQUIRED_COLS = ["Exchange", "Symbol", "Exchange Time", "User ID", "Quantity", "Avg Price", "Transaction", "Status"]
+FIFO_CACHE_SIZE = 4
+ORDERBOOK_CHUNK_ROWS = 50_000
+EDGE_COLUMNS = {"closing_fill_id": "int64", "opening_fill_id": "int64", "qty": "int64", "open_px": "float64", "close_px": "float64"}
+
+def _orderbook_digest(uploaded_file) -> str:
+    """SHA-256 of the uploaded order book bytes, used as part of the FIFO cache key."""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+def _filter_orderbook_chunk(df2: pd.DataFrame, symbol: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Keep COMPLETE fills for the index and parse Exchange Time; returns (fills, unparsable rows)."""
+    if symbol == "NIFTY":
+        df2 = df2[(df2["Exchange"] == "NFO") & (df2["Symbol"].str.contains("NIFTY", na=False)) & (df2["Status"] == "COMPLETE")]
+    elif symbol == "SENSEX":
+        df2 = df2[(df2["Status"] == "COMPLETE")]
+    df2 = df2.copy()
+
+    df2["Trading_Symbol"] = df2["Symbol"].astype(str).str.strip()
+    df2["Symbol"] = df2["Symbol"].astype(str).str[-7:]
+    df2["Strike_Name"] = df2["Symbol"]
+    df2["Exchange Time"] = df2["Exchange Time"].replace("01-Jan-0001 00:00:00", pd.NA)
+    df2["Exchange Time"] = pd.to_datetime(df2["Exchange Time"], format="%d-%b-%Y %H:%M:%S", errors="coerce")
+    nat_rows = df2[df2["Exchange Time"].isna()][["Exchange Time", "User ID", "Symbol"]]
+    return df2.dropna(subset=["Exchange Time"]), nat_rows
+
+def _read_orderbook(uploaded_file, symbol: str, chunksize: int = ORDERBOOK_CHUNK_ROWS) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Stream the order book in chunks, reading only the required columns.
+
+    Status/exchange/symbol predicates and the Exchange Time parse are applied per
+    chunk, so peak memory is bounded by the surviving fills plus one chunk.
+    """
+    uploaded_file.seek(0)
+    header = pd.read_csv(uploaded_file, nrows=0, index_col=False)
+    uploaded_file.seek(0)
+    missing_df2_cols = [col for col in ORDERBOOK_REQUIRED_COLS if col not in header.columns]
+    if missing_df2_cols:
+        raise ValueError(f"Missing columns in Order Book CSV: {', '.join(missing_df2_cols)}")
+
+    fills, nat_rows = [], []
+    for chunk in pd.read_csv(uploaded_file, index_col=False, usecols=ORDERBOOK_REQUIRED_COLS, chunksize=chunksize):
+        kept, bad = _filter_orderbook_chunk(chunk, symbol)
+        fills.append(kept)
+        nat_rows.append(bad)
+    if not fills:
+        empty = pd.DataFrame(columns=["Fill_ID"] + ORDERBOOK_REQUIRED_COLS + ["Strike_Name"])
+        return empty, empty[["Exchange Time", "User ID", "Symbol"]]
+    df2 = pd.concat(fills)
+    # Data-row position in the uploaded file; the match edge table refers to fills by this id.
+    df2.insert(0, "Fill_ID", df2.index.to_numpy(dtype=np.int64))
+    df2 = df2.sort_values(by="Exchange Time", kind="mergesort")
+    return df2, pd.concat(nat_rows)
+
+def _fifo_match_symbol(test_df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+    """FIFO-match one user's fills on one symbol and attach PNL / Net_Quantity / Exit_time columns.
+
+    Also returns the match edges (closing_fill_id, opening_fill_id, qty, open_px, close_px).
+    Every match step either exhausts the queued opening fill or completes the closing fill,
+    so there are at most len(test_df) edges and the edge arrays are preallocated to that size.
+    """
+    n = len(test_df)
+    qty = test_df["Quantity"].astype(int).to_numpy(copy=True)
+    price = test_df["Avg Price"].astype(float).to_numpy(copy=True)
+    txn = test_df["Transaction"].to_numpy(copy=True)
+    t = test_df["Exchange Time"].to_numpy(copy=True)
+    fill_id = test_df["Fill_ID"].to_numpy(dtype=np.int64)
+
+    pnl = np.zeros(n, dtype=float)
+    net_qty = np.zeros(n, dtype=int)
+    exit_time = pd.Series([pd.NaT] * n, dtype="datetime64[ns]").to_numpy()
+    matched_qty = np.zeros(n, dtype=int)
+    matched_value = np.zeros(n, dtype=float)
+
+    edge_close = np.empty(n, dtype=np.int64)
+    edge_open = np.empty(n, dtype=np.int64)
+    edge_qty = np.empty(n, dtype=np.int64)
+    edge_open_px = np.empty(n, dtype=float)
+    edge_close_px = np.empty(n, dtype=float)
+    k = 0
+
+    remain = np.abs(qty).astype(int)
+
+    # The first fill decides the opening side; the other side closes against the queue.
+    open_side = "SELL" if n > 0 and txn[0] == "SELL" else "BUY"
+    open_q = deque()
+    for i in range(n):
+        if txn[i] == open_side:
+            open_q.append([i, remain[i], price[i]])
+            continue
+        need = remain[i]
+        while need > 0 and open_q:
+            o_idx, o_rem, o_px = open_q[0]
+            matched = min(need, o_rem)
+            if open_side == "SELL":
+                pnl[i] += (o_px - price[i]) * matched
+            else:
+                pnl[i] += (price[i] - o_px) * matched
+            edge_close[k] = fill_id[i]
+            edge_open[k] = fill_id[o_idx]
+            edge_qty[k] = matched
+            edge_open_px[k] = o_px
+            edge_close_px[k] = price[i]
+            k += 1
+            matched_qty[i] += matched
+            matched_value[i] += o_px * matched
+            need -= matched
+            o_rem -= matched
+            if o_rem == 0:
+                if open_side == "BUY":
+                    exit_time[o_idx] = t[i]
+                open_q.popleft()
+            else:
+                open_q[0][1] = o_rem
+        if open_side == "SELL":
+            net_qty[i] = need
+            if need == 0:
+                exit_time[i] = t[i]
+        else:
+            net_qty[i] = -need
+    for o_idx, o_rem, _ in open_q:
+        net_qty[o_idx] = -o_rem if open_side == "SELL" else o_rem
+
+    test_df["PNL"] = pnl
+    test_df["Net_Quantity"] = net_qty
+    test_df["Exit_time"] = exit_time
+    test_df["Matched_Quantity"] = matched_qty
+    # Quantity-weighted average price of the opening fills this fill closed against
+    test_df["Matched_Price"] = np.divide(matched_value, matched_qty, out=np.zeros(n, dtype=float), where=matched_qty > 0)
+
+    edges = {
+        "closing_fill_id": edge_close[:k],
+        "opening_fill_id": edge_open[:k],
+        "qty": edge_qty[:k],
+        "open_px": edge_open_px[:k],
+        "close_px": edge_close_px[:k],
+    }
+    return test_df, edges
+
+def _edges_frame(edge_parts: List[Dict[str, np.ndarray]]) -> pd.DataFrame:
+    """Concatenate per-symbol edge arrays into the match-audit edge table."""
+    if not edge_parts:
+        return pd.DataFrame({col: np.array([], dtype=dtype) for col, dtype in EDGE_COLUMNS.items()})
+    return pd.DataFrame({
+        col: np.concatenate([part[col] for part in edge_parts]).astype(dtype, copy=False)
+        for col, dtype in EDGE_COLUMNS.items()
+    })
+
+def _fifo_match(df2: pd.DataFrame, noren_user: List) -> Dict:
+    """Run FIFO matching for every Noren user.
+
+    Returns realized PNL per user, the matched fills (x_df), the aggregated
+    carry-forward positions (df_final), the per-fill audit (df_detailed) and
+    the match edge table (edges) keyed by order book Fill_ID.
+    """
+    dict1 = {}
+    df_final = pd.DataFrame()
+    x_df = pd.DataFrame()
+    df_detailed = pd.DataFrame()
+    edge_parts = []
+
+    for user in noren_user:
+        df = df2[df2["User ID"] == user].copy()
+        sell_mask = df["Transaction"].eq("SELL")
+        df.loc[sell_mask, "Quantity"] = -df.loc[sell_mask, "Quantity"].abs()
+
+        if "PNL" not in df.columns:
+            df["PNL"] = 0.0
+        else:
+            df["PNL"] = df["PNL"].astype(float)
+        if "Exit_time" not in df.columns:
+            df["Exit_time"] = pd.NaT
+        else:
+            df["Exit_time"] = pd.to_datetime(df["Exit_time"], errors="coerce")
+        if "Net_Quantity" not in df.columns:
+            df["Net_Quantity"] = 0
+
+        total_realized_pnl = 0.0
+        new_df = pd.DataFrame()
+        user_detailed = []
+
+        # Match per traded contract so the same strike in two expiries never nets off
+        for sym in df["Trading_Symbol"].unique().tolist():
+            test_df = (
+                df[df["Trading_Symbol"] == sym]
+                .sort_values(["Exchange Time"], kind="mergesort")
+                .copy()
+                .reset_index(drop=True)
+            )
+            if test_df.empty:
+                continue
+
+            test_df, edges = _fifo_match_symbol(test_df)
+            edge_parts.append(edges)
+            user_detailed.append(test_df[["Fill_ID", "User ID", "Trading_Symbol", "Symbol", "Strike_Name", "Exchange Time", "Transaction", "Quantity", "Avg Price", "PNL", "Net_Quantity", "Exit_time", "Matched_Quantity", "Matched_Price"]])
+            new_df = pd.concat([new_df, test_df], ignore_index=True)
+            total_realized_pnl += float(test_df["PNL"].sum())
+
+        dict1[user] = total_realized_pnl
+        if new_df.empty:
+            continue
+        carry_fwd_pos_df_nfo = new_df[new_df["Net_Quantity"] != 0].copy()
+        x_df = pd.concat([x_df, new_df], ignore_index=True)
+        carry_fwd_pos_df_nfo["Value"] = carry_fwd_pos_df_nfo["Avg Price"] * carry_fwd_pos_df_nfo["Quantity"]
+        df_grouped = (
+            carry_fwd_pos_df_nfo
+            .groupby("Trading_Symbol", as_index=False)
+            .agg(
+                Symbol=("Symbol", "first"),
+                Total_Quantity=("Net_Quantity", "sum"),
+                Weighted_Avg_Price=("Avg Price", lambda x: (x * carry_fwd_pos_df_nfo.loc[x.index, "Quantity"]).sum() / carry_fwd_pos_df_nfo.loc[x.index, "Quantity"].sum() if carry_fwd_pos_df_nfo.loc[x.index, "Quantity"].sum() != 0 else 0),
+                Strike_Name=("Symbol", "first")
+            )
+        )
+
+        df_grouped["User ID"] = user
+        df_grouped["Calculated_Realized_PNL"] = total_realized_pnl
+        df_final = pd.concat([df_final, df_grouped], ignore_index=True)
+        if user_detailed:
+            df_detailed = pd.concat([df_detailed] + user_detailed, ignore_index=True)
+
+    return {"realized": dict1, "x_df": x_df, "df_final": df_final, "df_detailed": df_detailed, "edges": _edges_frame(edge_parts)}
+
+# -------------------- Settlement helpers --------------------
+RECON_KEYS = ["UserID", "Expiry", "Strike"]
+
+def _reconcile_pnl(broker: pd.DataFrame, computed: pd.DataFrame, tolerance: float) -> pd.DataFrame:
+    """Ranked broker-vs-computed breaks per (user, expiry, strike) whose realized or unrealized gap exceeds tolerance.
+
+    Both frames carry RECON_KEYS plus Realized / Unrealized; a contract missing on one side counts as 0 there.
+    """
+    sides = []
+    for frame, prefix in ((broker, "Broker"), (computed, "Calc")):
+        totals = frame.groupby(RECON_KEYS, dropna=False)[["Realized", "Unrealized"]].sum(min_count=1)
+        sides.append(totals.add_prefix(f"{prefix}_"))
+    recon = sides[0].join(sides[1], how="outer").reset_index()
+    recon["Side"] = np.select(
+        [recon["Broker_Realized"].isna() & recon["Broker_Unrealized"].isna(),
+         recon["Calc_Realized"].isna() & recon["Calc_Unrealized"].isna()],
+        ["computed only", "broker only"],
+        default="both"
+    )
+    value_cols = ["Broker_Realized", "Calc_Realized", "Broker_Unrealized", "Calc_Unrealized"]
+    recon[value_cols] = recon[value_cols].fillna(0.0)
+    recon["Realized_Diff"] = recon["Calc_Realized"] - recon["Broker_Realized"]
+    recon["Unrealized_Diff"] = recon["Calc_Unrealized"] - recon["Broker_Unrealized"]
+    recon["Total_Diff"] = recon["Realized_Diff"] + recon["Unrealized_Diff"]
+    recon["Break_Size"] = recon[["Realized_Diff", "Unrealized_Diff"]].abs().max(axis=1)
+    breaks = recon[recon["Break_Size"] > tolerance].sort_values("Break_Size", ascending=False, kind="mergesort")
+    breaks.insert(0, "Rank", np.arange(1, len(breaks) + 1))
+    return breaks.reset_index(drop=True)
+
+class _StageProfiler:
+    """Records wall time, rows in/out and (optionally) peak traced memory for each pipeline stage.
+
+    Stages are opened with begin() and closed with end(); opening a new stage closes the current one.
+    """
+
+    def __init__(self, track_memory: bool = False):
+        self.track_memory = track_memory
+        self.stages: List[Dict] = []
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self._current: Optional[Dict] = None
+        self._t0 = 0.0
+        self._owns_tracing = False
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracing = True
+
+    def begin(self, name: str, rows_in: Optional[int] = None) -> None:
+        if self._current is not None:
+            self.end()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        self._current = {"stage": name, "rows_in": rows_in, "rows_out": None, "wall_s": None, "peak_mem_mb": None}
+        self._t0 = time.perf_counter()
+
+    def end(self, rows_out: Optional[int] = None, rows_in: Optional[int] = None) -> None:
+        if self._current is None:
+            return
+        self._current["wall_s"] = round(time.perf_counter() - self._t0, 4)
+        self._current["rows_out"] = rows_out
+        if rows_in is not None:
+            self._current["rows_in"] = rows_in
+        if self.track_memory:
+            self._current["peak_mem_mb"] = round(tracemalloc.get_traced_memory()[1] / 1_048_576, 2)
+        self.stages.append(self._current)
+        self._current = None
+
+    def close(self) -> None:
+        self.end()
+        if self._owns_tracing:
+            tracemalloc.stop()
+            self._owns_tracing = False
+
+    def to_frame(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.stages, columns=["stage", "rows_in", "rows_out", "wall_s", "peak_mem_mb"])
+        return df.astype({"rows_in": "Int64", "rows_out": "Int64"})
+
+    def to_json(self, **meta) -> bytes:
+        payload = {"started_at": self.started_at, **meta, "stages": self.stages}
+        return json.dumps(payload, indent=2, default=str).encode("utf-8")
+
+def _cached_fifo(uploaded_orderbook, symbol: str, noren_user: List, profiler: Optional["_StageProfiler"] = None) -> Dict:
+    """FIFO result for (order book hash, symbol filter, user list), shared by the Calculate PNL and Realized PNL tabs.
+
+    A cache hit skips reading the order book entirely. Callers must copy frames before mutating them.
+    With a profiler, a miss times the order book read as its own stage, and the "FIFO" stage is left
+    open for the caller to close.
+    """
+    key = (_orderbook_digest(uploaded_orderbook), symbol, tuple(sorted(set(noren_user), key=str)))
+    cache = st.session_state.setdefault("fifo_cache", {})
+    hit = key in cache
+    if not hit:
+        if profiler is not None:
+            profiler.begin("orderbook read")
+        fills, nat_rows = _read_orderbook(uploaded_orderbook, symbol)
+        if profiler is not None:
+            profiler.end(rows_out=len(fills) + len(nat_rows))
+    if profiler is not None:
+        profiler.begin("FIFO")
+    if not hit:
+        result = _fifo_match(fills, list(dict.fromkeys(noren_user)))
+        result["nat_rows"] = nat_rows
+        result["fill_count"] = len(fills)
+        while len(cache) >= FIFO_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = result
+    return cache[key]
+
+class _IntradayFifoBook:
+    """Persistent per-(user, contract) FIFO state fed by tailing an order book CSV that is still growing.
+
+    Each poll() parses only the bytes appended since the previous poll (complete lines only) and
+    pushes the new COMPLETE fills through the same FIFO rules as _fifo_match_symbol: the first
+    fill of a (user, symbol) fixes the opening side, and closing quantity that finds no open lot
+    stays on the net position without being queued.
+    """
+
+    def __init__(self, path: str, symbol: str):
+        self.path = path
+        self.symbol = symbol
+        self.reset()
+
+    def reset(self) -> None:
+        self.offset = 0
+        self.header: Optional[List[str]] = None
+        self.positions: Dict[Tuple, Dict] = {}
+        self.rows_seen = 0
+        self.fills_applied = 0
+        self.last_batch = 0
+        self.bad_time_rows = 0
+        self.last_poll: Optional[datetime] = None
+
+    def poll(self) -> int:
+        """Apply fills appended since the last poll; returns the number of new fills."""
+        if os.path.getsize(self.path) < self.offset:
+            # Truncated or replaced (e.g. a new trading day): start over from the top
+            self.reset()
+        with open(self.path, "rb") as fh:
+            fh.seek(self.offset)
+            data = fh.read()
+        self.last_poll = datetime.now()
+        self.last_batch = 0
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return 0  # nothing new, or only a partially written line
+        data = data[:end]
+
+        if self.header is None:
+            header_end = data.index(b"\n") + 1
+            header = pd.read_csv(io.BytesIO(data[:header_end]), nrows=0, index_col=False).columns.tolist()
+            missing_df2_cols = [col for col in ORDERBOOK_REQUIRED_COLS if col not in header]
+            if missing_df2_cols:
+                raise ValueError(f"Missing columns in Order Book CSV: {', '.join(missing_df2_cols)}")
+            self.header = header
+            body = data[header_end:]
+        else:
+            body = data
+
+        if body.strip():
+            chunk = pd.read_csv(io.BytesIO(body), header=None, names=self.header, usecols=ORDERBOOK_REQUIRED_COLS, index_col=False)
+            self.rows_seen += len(chunk)
+            fills, nat_rows = _filter_orderbook_chunk(chunk, self.symbol)
+            self.bad_time_rows += len(nat_rows)
+            fills = fills.sort_values(by="Exchange Time", kind="mergesort")
+            for user, sym, txn, q, px in zip(fills["User ID"], fills["Trading_Symbol"], fills["Transaction"], fills["Quantity"], fills["Avg Price"]):
+                self._apply(user, sym, txn, abs(int(q)), float(px))
+            self.last_batch = len(fills)
+            self.fills_applied += len(fills)
+        self.offset += end
+        return self.last_batch
+
+    def _apply(self, user, sym: str, txn: str, qty: int, px: float) -> None:
+        state = self.positions.get((user, sym))
+        if state is None:
+            state = {"open_side": "SELL" if txn == "SELL" else "BUY", "queue": deque(), "realized": 0.0, "residual": 0, "fills": 0}
+            self.positions[(user, sym)] = state
+        state["fills"] += 1
+        queue = state["queue"]
+        if txn == state["open_side"]:
+            queue.append([qty, px])
+            return
+        need = qty
+        while need > 0 and queue:
+            o_rem, o_px = queue[0]
+            matched = min(need, o_rem)
+            if state["open_side"] == "SELL":
+                state["realized"] += (o_px - px) * matched
+            else:
+                state["realized"] += (px - o_px) * matched
+            need -= matched
+            if o_rem == matched:
+                queue.popleft()
+            else:
+                queue[0][0] = o_rem - matched
+        state["residual"] += need if state["open_side"] == "SELL" else -need
+
+    def snapshot(self) -> pd.DataFrame:
+        """Realized PNL and net position per (user, traded contract) as of the last poll."""
+        rows = []
+        for (user, sym), state in self.positions.items():
+            open_qty = sum(lot[0] for lot in state["queue"])
+            sign = -1 if state["open_side"] == "SELL" else 1
+            rows.append({
+                "User ID": user,
+                "Symbol": sym,
+                "Net_Quantity": sign * open_qty + state["residual"],
+                "Open_Avg_Price": (sum(lot[0] * lot[1] for lot in state["queue"]) / open_qty) if open_qty else 0.0,
+                "Realized_PNL": state["realized"],
+                "Fills": state["fills"]
+            })
+        return pd.DataFrame(rows, columns=["User ID", "Symbol", "Net_Quantity", "Open_Avg_Price", "Realized_PNL", "Fills"])
+
 def run():
     # Initialize session state to store calculated data
     if 'calculation_done' not in st.session_state:
@@ -30,6 +471,8 @@ def run():
         st.session_state.updated_usersetting_csv = None
         st.session_state.output_additional_excel = None
         st.session_state.expiry_str = None
+        st.session_state.stage_profile = None
+        st.session_state.df_recon = None
 
     # === NEW: Session state for Morning Position Verification ===
     if 'morning_verify_done' not in st.session_state:
@@ -309,7 +752,8 @@ def run():
     tabs = st.tabs([
         "Full PNL Calculation",
         "Noren Realized PNL Only",
-        "Morning Position Verification"  # NEW TAB
+        "Morning Position Verification",  # NEW TAB
+        "Intraday Live PNL"
     ])
     with tabs[0]:
         # Input Section
@@ -374,13 +818,17 @@ def run():
                 symbol = st.selectbox("Select Index", ["NIFTY", "SENSEX"], index=0, key="symbol")
             with col4:
                 expiry = st.date_input("Select Expiry Date", value=pd.to_datetime("2025-09-23"), key="expiry")
+            recon_tolerance = st.number_input("Reconciliation tolerance (₹)", min_value=0.0, value=1.0, step=0.5, key="recon_tolerance", help="Broker vs computed PNL gaps at or below this are not reported as breaks.")
+            track_memory = st.checkbox("Track peak memory per stage (slower)", value=False, key="profile_memory")
             st.markdown('</div>', unsafe_allow_html=True)
 
         # Calculate Button
         if st.button("Calculate PNL", use_container_width=True, key="calculate_pnl"):
             if (uploaded_usersetting or uploaded_summary) and uploaded_orderbook and uploaded_position and uploaded_bhav:
                 with st.spinner("Processing your data... This may take a moment for large files."):
+                    profiler = _StageProfiler(track_memory=track_memory)
                     try:
+                        profiler.begin("read")
                         # Read uploaded files safely
                         # ---------- Load User Settings OR Summary ----------
                         using_summary_file = False
@@ -421,11 +869,6 @@ def run():
                                 st.error(f"Error reading Summary Excel: {e}")
                                 return
 
-                        try:
-                            df2 = pd.read_csv(uploaded_orderbook, index_col=False)
-                        except Exception as e:
-                            st.error(f"Error reading Order Book CSV: {str(e)}")
-                            return
                         try:
                             df3 = pd.read_csv(uploaded_position)
                         except Exception as e:
@@ -437,6 +880,8 @@ def run():
                             st.error(f"Error reading Bhavcopy CSV: {str(e)}")
                             return
 
+                        profiler.end(rows_out=len(df1) + len(df3) + len(df_bhav))
+
                         # Check required columns in df1 (User Settings)
                         required_df1_cols = ["User ID", "Broker"]
                         missing_df1_cols = [col for col in required_df1_cols if col not in df1.columns]
@@ -454,7 +899,7 @@ def run():
                             st.error("Invalid symbol. Please select 'NIFTY' or 'SENSEX'.")
                             return
                         try:
-                            pd.to_datetime(expiry_str, format="%d-%m-%Y")
+                            expiry_ts = pd.to_datetime(expiry_str, format="%d-%m-%Y")
                         except ValueError:
                             st.error("Invalid expiry date format. Use DD-MM-YYYY.")
                             return
@@ -474,6 +919,7 @@ def run():
                         df3_not = df3[df3["UserID"].isin(not_noren_user)].copy()
 
                         # Bhavcopy cleaning and Strike Price Details
+                        profiler.begin("bhav clean", rows_in=len(df_bhav))
                         if symbol=="NIFTY":
                             required_bhav_cols = ["CONTRACT_D", "SETTLEMENT"]
                             missing_bhav_cols = [col for col in required_bhav_cols if col not in df_bhav.columns]
@@ -486,13 +932,20 @@ def run():
                             df_bhav["Date"] = pd.to_datetime(df_bhav["Date"], format="%d-%b-%Y", errors="coerce")
                             df_bhav["Strike_Type"] = df_bhav["Strike_Type"].str.replace(r'^(PE|CE)(\d+)$', r'\2\1', regex=True)
                             target_symbol = "OPTIDXNIFTY"
-                            df_bhav = df_bhav[(df_bhav["Date"] == pd.to_datetime(expiry_str, format="%d-%m-%Y")) & (df_bhav["Bhav_Symbol"] == target_symbol)]
+                            # Keep every expiry of the index; positions are settled against their own expiry
+                            df_bhav = df_bhav[df_bhav["Bhav_Symbol"] == target_symbol]
+                            expiry_col = "Date"
                             df3_not["Strike_Type"] = df3_not["Symbol"].str.extract(r'(\d+[A-Z]{2})$')
-                            df3_not = df3_not.merge(df_bhav[["Bhav_Symbol", "Strike_Type", "SETTLEMENT"]], left_on="Strike_Type", right_on="Strike_Type", how="left")
+                            df3_not["Expiry"] = parse_symbol_expiry(df3_not["Original_Symbol"], df_bhav[expiry_col]).fillna(expiry_ts)
+                            df3_not = df3_not.merge(
+                                df_bhav[[expiry_col, "Bhav_Symbol", "Strike_Type", "SETTLEMENT"]]
+                                    .drop_duplicates(subset=[expiry_col, "Strike_Type"], keep="last")
+                                    .rename(columns={expiry_col: "Expiry"}),
+                                on=["Expiry", "Strike_Type"], how="left"
+                            )
                             settelment = "SETTLEMENT"
                             symbols = "Bhav_Symbol"
-                            df_strike_details = df_bhav[["Strike_Type", "SETTLEMENT"]].copy()
-                            df_strike_details = df_strike_details.rename(columns={"Strike_Type": "Strike Price", "SETTLEMENT": "Settlement Price"})
+                            mapping_col = "Strike_Type"
                         elif symbol=="SENSEX":
                             required_bhav_cols = ["Market Summary Date", "Expiry Date", "Series Code", "Close Price"]
                             missing_bhav_cols = [col for col in required_bhav_cols if col not in df_bhav.columns]
@@ -502,24 +955,23 @@ def run():
                             df_bhav["Date"] = pd.to_datetime(df_bhav["Market Summary Date"], format="%d %b %Y", errors="coerce")
                             df_bhav["Expiry Date"] = pd.to_datetime(df_bhav["Expiry Date"], format="%d %b %Y", errors="coerce")
                             df_bhav["Symbols"] = df_bhav["Series Code"].astype(str).str[-7:]
-                            df_bhav = df_bhav[(df_bhav["Expiry Date"] == pd.to_datetime(expiry_str, format="%d-%m-%Y"))]
                             df_bhav["Symbols"] = df_bhav["Symbols"].astype(str).str.strip()
-                            bhav_mapping = df_bhav.drop_duplicates(subset="Symbols", keep="last").set_index("Symbols")["Close Price"]
-                            df3_not["Close Price"] = df3_not["Symbol"].map(bhav_mapping)
+                            expiry_col = "Expiry Date"
                             settelment = "Close Price"
                             symbols = "Symbols"
-                            df_strike_details = df_bhav[["Symbols", "Close Price"]].copy()
-                            df_strike_details = df_strike_details.rename(columns={"Symbols": "Strike Price", "Close Price": "Settlement Price"})
-
-                        df_strike_details = df_strike_details.drop_duplicates(subset=["Strike Price"]).sort_values(by="Strike Price")
-                        df_strike_details = df_strike_details[["Strike Price", "Settlement Price"]]
+                            mapping_col = "Symbols"
+                            df3_not["Expiry"] = parse_symbol_expiry(df3_not["Original_Symbol"], df_bhav[expiry_col]).fillna(expiry_ts)
+                            bhav_mapping = df_bhav.drop_duplicates(subset=[expiry_col, "Symbols"], keep="last").set_index([expiry_col, "Symbols"])["Close Price"]
+                            df3_not["Close Price"] = pd.MultiIndex.from_arrays([df3_not["Expiry"], df3_not["Symbol"]]).map(bhav_mapping)
 
                         if df_bhav["Date"].isna().any():
                             st.warning("Some dates in Bhavcopy could not be parsed and have been set to NaT.")
+                        profiler.end(rows_out=len(df_bhav))
 
                         df3_not["Strike_Name"] = df3_not["Original_Symbol"].str.extract(r'(\d+[A-Z]{2})$')
 
                         # Not Noren Calculation
+                        profiler.begin("non-Noren", rows_in=len(df3_not))
                         not_noren_data_pos = pd.DataFrame()
                         required_df3_cols = ["UserID", "Net Qty", "Sell Avg Price", "Buy Avg Price", "Sell Qty", "Buy Qty", "Realized Profit", "Unrealized Profit"]
                         missing_df3_cols = [col for col in required_df3_cols if col not in df3_not.columns]
@@ -558,182 +1010,49 @@ def run():
                             dict2[not_noren_user[i]] = total_realized_pnl
                             dict3[not_noren_user[i]] = total_unrealized_pnl
                             df3_not.loc[df3_not["UserID"] == not_noren_user[i], ["Calculated_Realized_PNL", "Calculated_Unrealized_PNL"]] = df[["Calculated_Realized_PNL", "Calculated_Unrealized_PNL"]]
+                        profiler.end(rows_out=len(not_noren_data_pos))
 
-                        # Noren Calculation with FIFO Logic
-                        required_df2_cols = ["Exchange", "Symbol", "Exchange Time", "User ID", "Quantity", "Avg Price", "Transaction", "Status"]
-                        missing_df2_cols = [col for col in required_df2_cols if col not in df2.columns]
-                        if missing_df2_cols:
-                            st.error(f"Missing columns in Order Book CSV: {', '.join(missing_df2_cols)}")
+                        # Noren Calculation with FIFO Logic (shared with the Realized PNL tab via the FIFO cache)
+                        try:
+                            fifo = _cached_fifo(uploaded_orderbook, symbol, noren_user, profiler)
+                        except ValueError as e:
+                            st.error(str(e))
                             return
-                        dict1 = {}
-                        dict4 = {}
-                        df_final = pd.DataFrame()
-                        x_df = pd.DataFrame()
-                        df_detailed = pd.DataFrame()
-
-                        if symbol == "NIFTY":
-                            df2 = df2[(df2["Exchange"] == "NFO") & (df2["Symbol"].str.contains("NIFTY")) & (df2["Status"] == "COMPLETE")]
-                        elif symbol == "SENSEX":
-                            df2 = df2[(df2["Status"] == "COMPLETE")]
-
-                        df2["Symbol"] = df2["Symbol"].astype(str).str[-7:]
-                        df2["Strike_Name"] = df2["Symbol"]
-                        df2["Exchange Time"] = df2["Exchange Time"].replace("01-Jan-0001 00:00:00", pd.NA)
-                        df2["Exchange Time"] = pd.to_datetime(df2["Exchange Time"], format="%d-%b-%Y %H:%M:%S", errors="coerce")
-                        nat_count = df2["Exchange Time"].isna().sum()
+                        except Exception as e:
+                            st.error(f"Error reading Order Book CSV: {str(e)}")
+                            return
+                        nat_count = len(fifo["nat_rows"])
                         if nat_count > 0:
                             st.warning(f"Found {nat_count} invalid or unparsable dates in Exchange Time column. These rows have been excluded from calculations.")
-                            st.dataframe(df2[df2["Exchange Time"].isna()][["Exchange Time", "User ID", "Symbol"]])
-                        df2 = df2.dropna(subset=["Exchange Time"]).sort_values(by="Exchange Time")
-
-                        for m in range(len(noren_user)):
-                            df = df2[df2["User ID"] == noren_user[m]].copy()
-                            sell_mask = df["Transaction"].eq("SELL")
-                            df.loc[sell_mask, "Quantity"] = -df.loc[sell_mask, "Quantity"].abs()
-
-                            if "PNL" not in df.columns:
-                                df["PNL"] = 0.0
-                            else:
-                                df["PNL"] = df["PNL"].astype(float)
-                            if "Exit_time" not in df.columns:
-                                df["Exit_time"] = pd.NaT
-                            else:
-                                df["Exit_time"] = pd.to_datetime(df["Exit_time"], errors="coerce")
-                            if "Net_Quantity" not in df.columns:
-                                df["Net_Quantity"] = 0
-
-                            lst1 = df["Symbol"].unique().tolist()
-                            total_realized_pnl = 0.0
-                            new_df = pd.DataFrame()
-                            user_detailed = []
-
-                            for sym in lst1:
-                                test_df = (
-                                    df[df["Symbol"] == sym]
-                                    .sort_values(["Exchange Time"], kind="mergesort")
-                                    .copy()
-                                    .reset_index(drop=True)
-                                )
-                                if test_df.empty:
-                                    continue
-
-                                qty = test_df["Quantity"].astype(int).to_numpy(copy=True)
-                                price = test_df["Avg Price"].astype(float).to_numpy(copy=True)
-                                txn = test_df["Transaction"].to_numpy(copy=True)
-                                t = test_df["Exchange Time"].to_numpy(copy=True)
-                                idx = test_df.index.to_numpy(copy=True)
-
-                                pnl = np.zeros(len(test_df), dtype=float)
-                                net_qty = np.zeros(len(test_df), dtype=int)
-                                exit_time = pd.Series([pd.NaT] * len(test_df), dtype="datetime64[ns]").to_numpy()
-                                matched_with = np.array([''] * len(test_df), dtype=object)
-                                matched_qty = np.zeros(len(test_df), dtype=int)
-                                matched_price = np.zeros(len(test_df), dtype=float)
-
-                                remain = np.abs(qty).astype(int)
-
-                                if len(txn) > 0 and txn[0] == "SELL":
-                                    sell_q = deque()
-                                    for i in range(len(test_df)):
-                                        if txn[i] == "SELL":
-                                            sell_q.append([i, remain[i], price[i]])
-                                        else:
-                                            need = remain[i]
-                                            total_matched = 0
-                                            matched_indices = []
-                                            matched_prices = []
-                                            while need > 0 and sell_q:
-                                                s_idx, s_rem, s_px = sell_q[0]
-                                                matched = min(need, s_rem)
-                                                pnl[i] += (s_px - price[i]) * matched
-                                                matched_indices.append(str(s_idx))
-                                                matched_prices.append(s_px)
-                                                total_matched += matched
-                                                need -= matched
-                                                s_rem -= matched
-                                                if s_rem == 0:
-                                                    sell_q.popleft()
-                                                else:
-                                                    sell_q[0][1] = s_rem
-                                            net_qty[i] = need
-                                            if need == 0:
-                                                exit_time[i] = t[i]
-                                            matched_with[i] = ";".join(matched_indices)
-                                            matched_qty[i] = total_matched
-                                            if matched_prices:
-                                                matched_price[i] = np.mean(matched_prices)
-                                    for s_idx, s_rem, _ in sell_q:
-                                        net_qty[s_idx] = -s_rem
-                                else:
-                                    buy_q = deque()
-                                    for i in range(len(test_df)):
-                                        if txn[i] == "BUY":
-                                            buy_q.append([i, remain[i], price[i]])
-                                        else:
-                                            need = remain[i]
-                                            total_matched = 0
-                                            matched_indices = []
-                                            matched_prices = []
-                                            while need > 0 and buy_q:
-                                                b_idx, b_rem, b_px = buy_q[0]
-                                                matched = min(need, b_rem)
-                                                pnl[i] += (price[i] - b_px) * matched
-                                                matched_indices.append(str(b_idx))
-                                                matched_prices.append(b_px)
-                                                total_matched += matched
-                                                need -= matched
-                                                b_rem -= matched
-                                                if b_rem == 0:
-                                                    exit_time[b_idx] = t[i]
-                                                    buy_q.popleft()
-                                                else:
-                                                    buy_q[0][1] = b_rem
-                                            net_qty[i] = -need
-                                            matched_with[i] = ";".join(matched_indices)
-                                            matched_qty[i] = total_matched
-                                            if matched_prices:
-                                                matched_price[i] = np.mean(matched_prices)
-                                    for b_idx, b_rem, _ in buy_q:
-                                        net_qty[b_idx] = b_rem
-
-                                test_df["PNL"] = pnl
-                                test_df["Net_Quantity"] = net_qty
-                                test_df["Exit_time"] = exit_time
-                                test_df["Matched_With"] = matched_with
-                                test_df["Matched_Quantity"] = matched_qty
-                                test_df["Matched_Price"] = matched_price
-
-                                user_detailed.append(test_df[["User ID", "Symbol", "Strike_Name", "Exchange Time", "Transaction", "Quantity", "Avg Price", "PNL", "Net_Quantity", "Exit_time", "Matched_With", "Matched_Quantity", "Matched_Price"]])
-                                new_df = pd.concat([new_df, test_df], ignore_index=True)
-                                total_realized_pnl += float(pnl.sum())
-
-                            carry_fwd_pos_df_nfo = new_df[new_df["Net_Quantity"] != 0].copy()
-                            x_df = pd.concat([x_df, new_df], ignore_index=True)
-                            carry_fwd_pos_df_nfo["Value"] = carry_fwd_pos_df_nfo["Avg Price"] * carry_fwd_pos_df_nfo["Quantity"]
-                            df_grouped = (
-                                carry_fwd_pos_df_nfo
-                                .groupby("Symbol", as_index=False)
-                                .agg(
-                                    Total_Quantity=("Net_Quantity", "sum"),
-                                    Weighted_Avg_Price=("Avg Price", lambda x: (x * carry_fwd_pos_df_nfo.loc[x.index, "Quantity"]).sum() / carry_fwd_pos_df_nfo.loc[x.index, "Quantity"].sum() if carry_fwd_pos_df_nfo.loc[x.index, "Quantity"].sum() != 0 else 0),
-                                    Strike_Name=("Symbol", "first")
-                                )
-                            )
-
-                            df_grouped["User ID"] = noren_user[m]
-                            df_grouped["Calculated_Realized_PNL"] = total_realized_pnl
-                            df_final = pd.concat([df_final, df_grouped], ignore_index=True)
-                            dict1[noren_user[m]] = total_realized_pnl
-                            if user_detailed:
-                                df_detailed = pd.concat([df_detailed] + user_detailed, ignore_index=True)
+                            st.dataframe(fifo["nat_rows"])
+                        dict1 = {user: fifo["realized"][user] for user in noren_user}
+                        dict4 = {}
+                        x_df = fifo["x_df"]
+                        df_final = fifo["df_final"].copy()
+                        df_detailed = fifo["df_detailed"]
+                        df_edges = fifo["edges"]
+                        profiler.end(rows_out=len(x_df), rows_in=fifo["fill_count"])
 
                         # === FIXED: Safe mapping with deduplicated keys ===
-                        mapping_col = 'Strike_Type' if symbol == "NIFTY" else 'Symbols'
+                        profiler.begin("aggregation", rows_in=len(df_final) + len(df3_not))
+                        # Settle each carried contract at its own expiry; symbols without one fall back to the selected expiry
+                        df_final["Expiry"] = parse_symbol_expiry(df_final["Trading_Symbol"], df_bhav[expiry_col]).fillna(expiry_ts)
                         mapping_series = (
-                            df_bhav.drop_duplicates(subset=[mapping_col])
-                                  .set_index(mapping_col)[settelment]
+                            df_bhav.drop_duplicates(subset=[expiry_col, mapping_col])
+                                  .set_index([expiry_col, mapping_col])[settelment]
+                        )
+                        df_final[settelment] = pd.MultiIndex.from_arrays([df_final["Expiry"], df_final["Symbol"]]).map(mapping_series)
+
+                        # Only the expiries actually held are reported in the BhavCopy / Strike Price Details sheets
+                        bhav_expiries = df_bhav[expiry_col].dropna().unique()
+                        held_expiries = pd.concat([df3_not["Expiry"], df_final["Expiry"]]).dropna().unique()
+                        df_bhav = df_bhav[df_bhav[expiry_col].isin(held_expiries)]
+                        df_strike_details = (
+                            df_bhav[[expiry_col, mapping_col, settelment]]
+                            .rename(columns={expiry_col: "Expiry", mapping_col: "Strike Price", settelment: "Settlement Price"})
+                            .drop_duplicates(subset=["Expiry", "Strike Price"])
+                            .sort_values(by=["Expiry", "Strike Price"])
                         )
-                        df_final[settelment] = df_final['Symbol'].map(mapping_series)
 
                         df_final["Calculated_Unrealized_PNL"] = np.select(
                             [
@@ -810,8 +1129,43 @@ def run():
                         df_pivot.columns = ["UserID", "Sum of settlement value"]
                         grand_total = pd.DataFrame({"UserID": ["Grand Total"], "Sum of settlement value": [df_pivot["Sum of settlement value"].sum()]})
                         df_pivot = pd.concat([df_pivot, grand_total], ignore_index=True)
+                        profiler.end(rows_out=len(df_position_detailed))
+
+                        # Broker vs computed reconciliation, all users in one merge
+                        profiler.begin("reconciliation", rows_in=len(df3) + len(x_df) + len(df_final))
+                        df3_users = df3[df3["UserID"].isin(noren_user + not_noren_user)]
+                        broker_side = pd.DataFrame({
+                            "UserID": df3_users["UserID"],
+                            "Expiry": parse_symbol_expiry(df3_users["Original_Symbol"], bhav_expiries).fillna(expiry_ts),
+                            "Strike": df3_users["Symbol"],
+                            "Realized": pd.to_numeric(df3_users.get("Realized Profit"), errors="coerce"),
+                            "Unrealized": pd.to_numeric(df3_users.get("Unrealized Profit"), errors="coerce")
+                        })
+                        calc_parts = [pd.DataFrame({
+                            "UserID": df3_not["UserID"],
+                            "Expiry": df3_not["Expiry"],
+                            "Strike": df3_not["Symbol"],
+                            "Realized": df3_not["Calculated_Realized_PNL"],
+                            "Unrealized": df3_not["Calculated_Unrealized_PNL"]
+                        })]
+                        if not x_df.empty:
+                            noren_contracts = (
+                                x_df.groupby(["User ID", "Trading_Symbol"], as_index=False)
+                                    .agg(Strike=("Symbol", "first"), Realized=("PNL", "sum"))
+                                    .merge(df_final[["User ID", "Trading_Symbol", "Calculated_Unrealized_PNL"]], on=["User ID", "Trading_Symbol"], how="left")
+                            )
+                            calc_parts.append(pd.DataFrame({
+                                "UserID": noren_contracts["User ID"],
+                                "Expiry": parse_symbol_expiry(noren_contracts["Trading_Symbol"], bhav_expiries).fillna(expiry_ts),
+                                "Strike": noren_contracts["Strike"],
+                                "Realized": noren_contracts["Realized"],
+                                "Unrealized": noren_contracts["Calculated_Unrealized_PNL"].fillna(0.0)
+                            }))
+                        df_recon = _reconcile_pnl(broker_side, pd.concat(calc_parts, ignore_index=True), recon_tolerance)
+                        profiler.end(rows_out=len(df_recon))
 
                         # Max Loss Calculation
+                        profiler.begin("max-loss", rows_in=len(df1))
                         telegram_col = "Telegram ID(s)"
                         alias_col="User Alias"
                         if telegram_col not in df1.columns:
@@ -864,12 +1218,14 @@ def run():
                                 })
 
                             df_maxloss = pd.DataFrame(maxloss_rows)
+                            profiler.end(rows_out=len(df_maxloss))
 
                             total_realized = df_display["REALIZED_PNL"].sum()
                             total_unrealized = df_display["UNREALIZED_PNL"].sum()
                             total_pnl = total_realized + total_unrealized
                             num_users = len(df_display)
 
+                            profiler.begin("export", rows_in=len(x_df) + len(df_final) + len(not_noren_data_pos))
                             # ---------- Generate Updated UserSetting CSV (only if NOT using summary) ----------
                             if not using_summary_file:
                                 output = io.StringIO()
@@ -885,6 +1241,8 @@ def run():
                                 df_pivot.to_excel(writer, sheet_name="Pivot", index=False)
                                 df_maxloss.to_excel(writer, sheet_name="Calculation", index=False)
                                 x_df.to_excel(writer, sheet_name="Noren Realized Data", index=False)
+                                df_edges.to_excel(writer, sheet_name="FIFO Match Audit", index=False)
+                                df_recon.to_excel(writer, sheet_name="PNL Reconciliation", index=False)
                                 df_final.to_excel(writer, sheet_name="Noren UnRealized Data", index=False)
                                 not_noren_data_pos.to_excel(writer, sheet_name="Not Noren Data Pos", index=False)
                                 df_bhav.to_excel(writer, sheet_name="BhavCopy", index=False)
@@ -1028,6 +1386,12 @@ def run():
                             # Finalize
                             max_loss_buf.seek(0)
                             st.session_state.max_loss_calc_excel = max_loss_buf 
+                            profiler.end(rows_out=len(df3_data))
+                            profiler.close()
+                            st.session_state.stage_profile = {
+                                "table": profiler.to_frame(),
+                                "json": profiler.to_json(symbol=symbol, expiry=expiry_str)
+                            }
                                                        
                             # Store in session
                             st.session_state.calculation_done = True
@@ -1039,6 +1403,12 @@ def run():
                             st.session_state.num_users = num_users
                             st.session_state.updated_usersetting_csv = updated_usersetting_csv
                             st.session_state.output_additional_excel = output_additional_excel
+                            try:
+                                st.session_state.match_audit_parquet = df_edges.to_parquet(index=False)
+                            except ImportError:
+                                # Parquet needs pyarrow or fastparquet; the audit is still in the XLSX sheet
+                                st.session_state.match_audit_parquet = None
+                            st.session_state.df_recon = df_recon
                             st.session_state.expiry_str = expiry_str
 
                             st.success("Calculation completed! Explore the insights below.")
@@ -1046,6 +1416,8 @@ def run():
                     except Exception as e:
                         st.error(f"An error occurred during calculation: {str(e)}")
                         st.exception(e)
+                    finally:
+                        profiler.close()
             else:
                 st.warning("Please upload all four files to proceed.")
 
@@ -1163,9 +1535,49 @@ def run():
                         st.caption("Run the calculation first.")
                 # ─────── END NEW BUTTON ───────
 
+                if st.session_state.get("match_audit_parquet") is not None:
+                    st.download_button(
+                        label="Download FIFO Match Audit (Parquet)",
+                        data=st.session_state.match_audit_parquet,
+                        file_name=f"A8_fifo_match_audit_{st.session_state.expiry_str}.parquet",
+                        mime="application/octet-stream",
+                        key="download_match_audit"
+                    )
+
                 st.markdown('</div>', unsafe_allow_html=True)
                 st.markdown('</div>', unsafe_allow_html=True)
 
+            # Broker vs computed reconciliation
+            df_recon = st.session_state.get("df_recon")
+            if df_recon is not None:
+                with st.expander(f"🔍 Broker vs Computed Reconciliation ({len(df_recon)} breaks)", expanded=False):
+                    if df_recon.empty:
+                        st.success("Broker and computed PNL agree within tolerance for every user and contract.")
+                    else:
+                        st.dataframe(df_recon, use_container_width=True, hide_index=True)
+                        st.caption("Ranked by the larger of the realized and unrealized gap. Also saved in the 'PNL Reconciliation' sheet of the additional data file.")
+
+            # Stage Profile
+            stage_profile = st.session_state.get("stage_profile")
+            if stage_profile is not None:
+                with st.expander("⏱️ Stage Profile", expanded=False):
+                    st.dataframe(
+                        stage_profile["table"].style.format({
+                            "wall_s": "{:.3f}",
+                            "peak_mem_mb": lambda v: "" if pd.isna(v) else f"{v:.2f}"
+                        }, na_rep=""),
+                        use_container_width=True,
+                        hide_index=True
+                    )
+                    st.caption(f"Total wall time: {stage_profile['table']['wall_s'].sum():.2f}s")
+                    st.download_button(
+                        label="Download Stage Profile JSON",
+                        data=stage_profile["json"],
+                        file_name=f"A8_stage_profile_{st.session_state.expiry_str}.json",
+                        mime="application/json",
+                        key="download_stage_profile"
+                    )
+
     with tabs[1]:
         # Noren Realized PNL Section
         with st.container():
@@ -1208,7 +1620,6 @@ def run():
                     try:
                         # Read uploaded files
                         df1_r = pd.read_excel(uploaded_usersetting_r)
-                        df2_r = pd.read_csv(uploaded_orderbook_r, index_col=False)
 
                         # Get Noren users
                         temp_r = df1_r[df1_r["Broker"] == "MasterTrust_Noren"]
@@ -1219,141 +1630,17 @@ def run():
                             st.error("❌ Invalid symbol. Please select 'NIFTY' or 'SENSEX'.")
                             return
 
-                        # Noren Calculation with FIFO Logic (only realized)
-                        required_df2_cols_r = ["Exchange", "Symbol", "Exchange Time", "User ID", "Quantity", "Avg Price", "Transaction", "Status"]
-                        missing_df2_cols_r = [col for col in required_df2_cols_r if col not in df2_r.columns]
-                        if missing_df2_cols_r:
-                            st.error(f"❌ Missing columns in Order Book CSV: {', '.join(missing_df2_cols_r)}")
+                        # Realized-only view: projection of the cached FIFO result, no re-matching
+                        try:
+                            fifo_r = _cached_fifo(uploaded_orderbook_r, symbol_r, noren_user_r)
+                        except ValueError as e:
+                            st.error(f"❌ {str(e)}")
                             return
-
-                        dict1_r = {}
-
-                        if symbol_r == "NIFTY":
-                            df2_r = df2_r[(df2_r["Exchange"] == "NFO") & (df2_r["Symbol"].str.contains("NIFTY")) & (df2_r["Status"] == "COMPLETE")]
-                        elif symbol_r == "SENSEX":
-                            df2_r = df2_r[(df2_r["Status"] == "COMPLETE")]
-
-                        # Preprocess df2_r
-                        df2_r["Symbol"] = df2_r["Symbol"].astype(str).str[-7:]
-                        df2_r["Strike_Name"] = df2_r["Symbol"]
-                        df2_r["Exchange Time"] = df2_r["Exchange Time"].replace("01-Jan-0001 00:00:00", pd.NA)
-                        df2_r["Exchange Time"] = pd.to_datetime(df2_r["Exchange Time"], format="%d-%b-%Y %H:%M:%S", errors="coerce")
-                        nat_count_r = df2_r["Exchange Time"].isna().sum()
+                        nat_count_r = len(fifo_r["nat_rows"])
                         if nat_count_r > 0:
                             st.warning(f"⚠️ Found {nat_count_r} invalid or unparsable dates in Exchange Time column. These rows have been excluded from calculations.")
-                            st.dataframe(df2_r[df2_r["Exchange Time"].isna()][["Exchange Time", "User ID", "Symbol"]])
-                        df2_r = df2_r.dropna(subset=["Exchange Time"]).sort_values(by="Exchange Time")
-
-                        for m in range(len(noren_user_r)):
-                            df_r = df2_r[df2_r["User ID"] == noren_user_r[m]].copy()
-                            sell_mask_r = df_r["Transaction"].eq("SELL")
-                            df_r.loc[sell_mask_r, "Quantity"] = -df_r.loc[sell_mask_r, "Quantity"].abs()
-
-                            if "PNL" not in df_r.columns:
-                                df_r["PNL"] = 0.0
-                            else:
-                                df_r["PNL"] = df_r["PNL"].astype(float)
-                            if "Exit_time" not in df_r.columns:
-                                df_r["Exit_time"] = pd.NaT
-                            else:
-                                df_r["Exit_time"] = pd.to_datetime(df_r["Exit_time"], errors="coerce")
-                            if "Net_Quantity" not in df_r.columns:
-                                df_r["Net_Quantity"] = 0
-
-                            lst1_r = df_r["Symbol"].unique().tolist()
-                            total_realized_pnl_r = 0.0
-
-                            for sym_r in lst1_r:
-                                test_df_r = (
-                                    df_r[df_r["Symbol"] == sym_r]
-                                    .sort_values(["Exchange Time"], kind="mergesort")
-                                    .copy()
-                                    .reset_index(drop=True)
-                                )
-                                if test_df_r.empty:
-                                    continue
-
-                                qty_r = test_df_r["Quantity"].astype(int).to_numpy(copy=True)
-                                price_r = test_df_r["Avg Price"].astype(float).to_numpy(copy=True)
-                                txn_r = test_df_r["Transaction"].to_numpy(copy=True)
-                                t_r = test_df_r["Exchange Time"].to_numpy(copy=True)
-
-                                pnl_r = np.zeros(len(test_df_r), dtype=float)
-                                net_qty_r = np.zeros(len(test_df_r), dtype=int)
-                                exit_time_r = pd.Series([pd.NaT] * len(test_df_r), dtype="datetime64[ns]").to_numpy()
-                                matched_with_r = np.array([''] * len(test_df_r), dtype=object)
-                                matched_qty_r = np.zeros(len(test_df_r), dtype=int)
-                                matched_price_r = np.zeros(len(test_df_r), dtype=float)
-
-                                remain_r = np.abs(qty_r).astype(int)
-
-                                if len(txn_r) > 0 and txn_r[0] == "SELL":
-                                    sell_q_r = deque()
-                                    for i in range(len(test_df_r)):
-                                        if txn_r[i] == "SELL":
-                                            sell_q_r.append([i, remain_r[i], price_r[i]])
-                                        else:  # BUY
-                                            need = remain_r[i]
-                                            total_matched = 0
-                                            matched_indices = []
-                                            matched_prices = []
-                                            while need > 0 and sell_q_r:
-                                                s_idx, s_rem, s_px = sell_q_r[0]
-                                                matched = min(need, s_rem)
-                                                pnl_r[i] += (s_px - price_r[i]) * matched
-                                                matched_indices.append(str(s_idx))
-                                                matched_prices.append(s_px)
-                                                total_matched += matched
-                                                need -= matched
-                                                s_rem -= matched
-                                                if s_rem == 0:
-                                                    sell_q_r.popleft()
-                                                else:
-                                                    sell_q_r[0][1] = s_rem
-                                            net_qty_r[i] = need
-                                            if need == 0:
-                                                exit_time_r[i] = t_r[i]
-                                            matched_with_r[i] = ";".join(matched_indices)
-                                            matched_qty_r[i] = total_matched
-                                            if matched_prices:
-                                                matched_price_r[i] = np.mean(matched_prices)
-                                    for s_idx, s_rem, _ in sell_q_r:
-                                        net_qty_r[s_idx] = -s_rem
-                                else:
-                                    buy_q_r = deque()
-                                    for i in range(len(test_df_r)):
-                                        if txn_r[i] == "BUY":
-                                            buy_q_r.append([i, remain_r[i], price_r[i]])
-                                        else:  # SELL
-                                            need = remain_r[i]
-                                            total_matched = 0
-                                            matched_indices = []
-                                            matched_prices = []
-                                            while need > 0 and buy_q_r:
-                                                b_idx, b_rem, b_px = buy_q_r[0]
-                                                matched = min(need, b_rem)
-                                                pnl_r[i] += (price_r[i] - b_px) * matched
-                                                matched_indices.append(str(b_idx))
-                                                matched_prices.append(b_px)
-                                                total_matched += matched
-                                                need -= matched
-                                                b_rem -= matched
-                                                if b_rem == 0:
-                                                    exit_time_r[b_idx] = t_r[i]
-                                                    buy_q_r.popleft()
-                                                else:
-                                                    buy_q_r[0][1] = b_rem
-                                            net_qty_r[i] = -need
-                                            matched_with_r[i] = ";".join(matched_indices)
-                                            matched_qty_r[i] = total_matched
-                                            if matched_prices:
-                                                matched_price_r[i] = np.mean(matched_prices)
-                                    for b_idx, b_rem, _ in buy_q_r:
-                                        net_qty_r[b_idx] = b_rem
-
-                                total_realized_pnl_r += float(pnl_r.sum())
-
-                            dict1_r[noren_user_r[m]] = total_realized_pnl_r
+                            st.dataframe(fifo_r["nat_rows"])
+                        dict1_r = {user: fifo_r["realized"][user] for user in noren_user_r}
 
                         # Display results
                         rows_r = []
@@ -1586,6 +1873,113 @@ def run():
 
             st.markdown('</div>', unsafe_allow_html=True)
     
+    # ========================================
+    # TAB 4: Intraday Live PNL
+    # ========================================
+    with tabs[3]:
+        st.markdown('<div class="section-card">', unsafe_allow_html=True)
+        st.subheader("Intraday Live PNL")
+        st.caption("Tails an order book CSV that is still being written on this machine. Each refresh parses only the rows appended since the last one.")
+        col1, col2 = st.columns(2)
+        with col1:
+            intraday_path = st.text_input("Order Book CSV path", key="intraday_path", placeholder="D:/VS1/ORDERBOOK.csv")
+        with col2:
+            symbol_i = st.selectbox("Select Index", ["NIFTY", "SENSEX"], index=0, key="symbol_i")
+        col3, col4 = st.columns(2)
+        with col3:
+            auto_refresh = st.checkbox("Auto-refresh", value=False, key="intraday_auto")
+        with col4:
+            refresh_secs = st.number_input("Refresh every (seconds)", min_value=2, max_value=300, value=10, key="intraday_secs")
+        st.markdown('</div>', unsafe_allow_html=True)
+
+        col_start, col_reset = st.columns(2)
+        with col_start:
+            start_intraday = st.button("Start / Refresh", use_container_width=True, key="intraday_start")
+        with col_reset:
+            reset_intraday = st.button("Reset Intraday State", use_container_width=True, key="intraday_reset")
+
+        if reset_intraday:
+            st.session_state.intraday_book = None
+
+        def poll_intraday(book):
+            try:
+                book.poll()
+            except ValueError as e:
+                st.error(str(e))
+            except OSError as e:
+                st.error(f"Error reading Order Book CSV: {str(e)}")
+
+        if start_intraday:
+            if not intraday_path or not os.path.isfile(intraday_path):
+                st.warning("Please enter the path of an existing Order Book CSV.")
+            else:
+                book = st.session_state.get("intraday_book")
+                if book is None or book.path != intraday_path or book.symbol != symbol_i:
+                    book = _IntradayFifoBook(intraday_path, symbol_i)
+                    st.session_state.intraday_book = book
+                poll_intraday(book)
+
+        @st.fragment(run_every=refresh_secs if auto_refresh else None)
+        def intraday_panel():
+            book = st.session_state.get("intraday_book")
+            if book is None:
+                st.info("Enter the order book path and click Start / Refresh.")
+                return
+            if auto_refresh:
+                poll_intraday(book)
+            live = book.snapshot()
+            total_realized_i = live["Realized_PNL"].sum()
+            open_positions = int((live["Net_Quantity"] != 0).sum())
+
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.markdown(f"""
+                <div class="metric-card">
+                    <h3>₹{total_realized_i:,.2f}</h3>
+                    <p>Live Realized PNL</p>
+                    <span class="{'positive' if total_realized_i >= 0 else 'negative'}">●</span>
+                </div>
+                """, unsafe_allow_html=True)
+            with col2:
+                st.markdown(f"""
+                <div class="metric-card">
+                    <h3>{open_positions}</h3>
+                    <p>Open Positions</p>
+                    <span class="positive">●</span>
+                </div>
+                """, unsafe_allow_html=True)
+            with col3:
+                st.markdown(f"""
+                <div class="metric-card">
+                    <h3>{book.fills_applied} (+{book.last_batch})</h3>
+                    <p>Fills Applied</p>
+                    <span class="positive">●</span>
+                </div>
+                """, unsafe_allow_html=True)
+            last_refresh = book.last_poll.strftime("%H:%M:%S") if book.last_poll else "-"
+            st.caption(f"Last refresh: {last_refresh} | Rows read: {book.rows_seen} | Rows with invalid Exchange Time: {book.bad_time_rows}")
+
+            per_user = live.groupby("User ID", as_index=False).agg(
+                Realized_PNL=("Realized_PNL", "sum"),
+                Open_Positions=("Net_Quantity", lambda q: int((q != 0).sum()))
+            )
+            st.dataframe(
+                per_user.style.format({"Realized_PNL": "{:.2f}"}).map(
+                    lambda x: "color: #EF4444" if isinstance(x, (int, float)) and x < 0 else "color: #10B981",
+                    subset=["Realized_PNL"]
+                ),
+                use_container_width=True,
+                hide_index=True
+            )
+            with st.expander("Positions by Symbol", expanded=False):
+                st.dataframe(
+                    live.style.format({"Open_Avg_Price": "{:.2f}", "Realized_PNL": "{:.2f}"}),
+                    use_container_width=True,
+                    hide_index=True
+                )
+
+        intraday_panel()
+
     # Footer
     st.markdown('<div class="footer">Powered by Streamlit | Designed for 2025 UX Excellence | Developed by Sahil</div>', unsafe_allow_html=True)
     st.markdown('</div>', unsafe_allow_html=True)
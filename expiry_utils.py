@@ -0,0 +1,55 @@
+"""Option symbol expiry parsing shared by the algo8 and algo19 PNL pages."""
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+WEEKLY_MONTH_CODES = {**{str(i): i for i in range(1, 10)}, "O": 10, "N": 11, "D": 12}
+
+def parse_symbol_expiry(symbols: pd.Series, known_expiries: Optional[pd.Series] = None) -> pd.Series:
+    """Expiry date encoded in each option symbol, NaT where no expiry can be recognised.
+
+    Understands exchange weekly (NIFTY2592324500CE), exchange monthly (NIFTY25SEP24500CE),
+    DDMMMYYYY (NIFTY 23-SEP-2025 CE 24500) and DDMMMYY (NIFTY23SEP25C24500) symbols. Monthly
+    symbols carry no day, so they resolve to the last of known_expiries falling in that month.
+
+    >>> parse_symbol_expiry(pd.Series(["NIFTY2592324500CE", "NIFTY 23-SEP-2025 CE 24500", "NIFTY23SEP25C24500"])).dt.date.tolist()
+    [datetime.date(2025, 9, 23), datetime.date(2025, 9, 23), datetime.date(2025, 9, 23)]
+    >>> parse_symbol_expiry(pd.Series(["NIFTY25SEP24500CE", "NIFTY25O0724500PE"]), pd.Series(["2025-09-23", "2025-09-30"])).dt.date.tolist()
+    [datetime.date(2025, 9, 30), datetime.date(2025, 10, 7)]
+    >>> parse_symbol_expiry(pd.Series(["NIFTY25SEP24500CE", "BANKNIFTY"])).isna().tolist()
+    [True, True]
+    """
+    months = "|".join(MONTHS)
+    s = symbols.astype(str).str.upper().str.replace(r"[\s\-_/]", "", regex=True)
+    parts = pd.DataFrame(np.nan, index=s.index, columns=["year", "month", "day"])
+    patterns = [
+        ("weekly", r"^[A-Z]+(?P<year>\d{2})(?P<month>[1-9OND])(?P<day>\d{2})\d+(?:CE|PE)$"),
+        ("monthly", rf"^[A-Z]+(?P<year>\d{{2}})(?P<month>{months})\d{{4,6}}(?:CE|PE)$"),
+        ("ddmmmyyyy", rf"(?P<day>\d{{2}})(?P<month>{months})(?P<year>20\d{{2}})"),
+        ("ddmmmyy", rf"(?P<day>\d{{2}})(?P<month>{months})(?P<year>\d{{2}})"),
+    ]
+    monthly = pd.Series(False, index=s.index)
+    for name, pattern in patterns:
+        found = s.str.extract(pattern)
+        if "day" not in found.columns:
+            found["day"] = np.nan
+        take = parts["year"].isna() & found["year"].notna()
+        if not take.any():
+            continue
+        found = found[take]
+        month = found["month"].map(WEEKLY_MONTH_CODES) if name == "weekly" else found["month"].map({m: i for i, m in enumerate(MONTHS, 1)})
+        year = found["year"].astype(int)
+        parts.loc[take, "year"] = np.where(year < 100, year + 2000, year)
+        parts.loc[take, "month"] = month
+        parts.loc[take, "day"] = found["day"].astype(float)
+        if name == "monthly":
+            monthly |= take
+
+    expiry = pd.to_datetime(parts[~monthly].dropna(), errors="coerce").reindex(s.index)
+    if monthly.any() and known_expiries is not None:
+        known = pd.Series(pd.to_datetime(known_expiries, errors="coerce")).dropna()
+        last_in_month = known.groupby([known.dt.year, known.dt.month]).max().to_dict()
+        expiry[monthly] = [last_in_month.get((int(y), int(m)), pd.NaT) for y, m in parts.loc[monthly, ["year", "month"]].itertuples(index=False)]
+    return expiry
@@ -9,6 +9,9 @@ import openpyxl
 import hashlib
 import logging
 import time
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Configure logging
 logging.basicConfig(
@@ -28,384 +31,443 @@ def hash_password(password):
 VALID_USERNAME = "Access_User"
 VALID_PASSWORD_HASH = hash_password("Jainam@135")
 
+# Number of parsed sheets kept in the session cache (one month needs three)
+FILE_CACHE_SIZE = 6
+
+# Append-only local store of parsed Compiled MTM and Record rows: one Parquet
+# part per (date, source file) so a day is read without rescanning a workbook
+HISTORY_DIR = 'jainam_history'
+
+# Stage timings of every run (JSON lines); recent runs weight the progress bar
+STAGE_LOG = 'jainam_stage_metrics.jsonl'
+STAGE_HISTORY_LINES = 2000
+LOAD_STAGES = ['Read files', 'Validate files', 'Index sections', 'MTM section',
+               'Capital Deployed section', 'Max SL section', 'Filter file1 by IDs', 'Parse Record sheet']
+DAY_STAGES = ['Filter by date', 'Map values', 'Expand alias rows', 'Select Record date',
+              'Fill component allocations', 'Handle unnamed column', 'Map MTM',
+              'Proportional MTM allocation', 'Combine and clean']
+
 def to_excel(df):
+    return to_excel_sheets({'Sheet1': df})
+
+def to_excel_sheets(frames):
     try:
         buffer = BytesIO()
         with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Sheet1', index=False)
+            for sheet_name, df in frames.items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
         return buffer.getvalue()
     except Exception as e:
-        logger.error(f"Error in to_excel: {str(e)}")
+        logger.error(f"Error in to_excel_sheets: {str(e)}")
         raise
 
+def file_digest(file):
+    return hashlib.sha256(file.getvalue()).hexdigest()
+
+def _history_manifest(kind):
+    return os.path.join(HISTORY_DIR, kind, '_ingested.txt')
+
+def history_stamp(kind, digest):
+    """Ingest stamp of a file in the manifest, or None if it was never fully ingested.
+
+    The manifest line is only written after every part, so parts left by an
+    interrupted or concurrent ingest carry other stamps and are never read.
+    """
+    path = _history_manifest(kind)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == digest:
+                return fields[1]
+    return None
+
+def _history_part(kind, day, digest, stamp):
+    return os.path.join(HISTORY_DIR, kind, day.isoformat(), f"{stamp}-{digest[:16]}.parquet")
+
+def report_history_error(error_msg):
+    """Surface a history store failure in the page and the error log; the run goes on from the workbook."""
+    logger.warning(error_msg)
+    st.session_state.setdefault('error_logs', []).append(f"{datetime.now()}: {error_msg}")
+    st.warning(error_msg)
+
+def ingest_history(kind, digest, frame, sort_by=None):
+    """Append a parsed frame to the history store as one Parquet part per date.
+
+    sort_by orders each part (e.g. by UserID) so reads can filter on it.
+    """
+    if history_stamp(kind, digest) is not None:
+        return
+    try:
+        start_time = time.time()
+        stamp = str(time.time_ns())
+        dated = frame[frame['Date'].notna()]
+        for day, rows in dated.groupby(dated['Date'].dt.date, sort=False):
+            if sort_by:
+                rows = rows.sort_values(sort_by, kind='stable')
+            path = _history_part(kind, day, digest, stamp)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            rows.reset_index(drop=True).to_parquet(path, index=False)
+        with open(_history_manifest(kind), 'a') as f:
+            f.write(f"{digest} {stamp}\n")
+        logger.info(f"Stored {len(dated)} {kind} rows in history in {time.time() - start_time:.2f} seconds")
+    except Exception as e:
+        report_history_error(f"Could not add {kind} rows to the history store: {str(e)}")
+
+def history_slice(kind, digest, days, users=None):
+    """Return an ingested file's rows for the given days (and UserIDs), or None to fall back to the workbook."""
+    stamp = history_stamp(kind, digest) if days is not None else None
+    if stamp is None:
+        return None
+    try:
+        filters = [('UserID', 'in', list(users))] if users is not None else None
+        parts = []
+        for day in days:
+            path = _history_part(kind, pd.Timestamp(day).date(), digest, stamp)
+            if os.path.exists(path):
+                parts.append(pd.read_parquet(path, filters=filters))
+        if not parts:
+            return None
+        logger.info(f"Loaded {kind} rows for {len(parts)} dates from history")
+        return pd.concat(parts, ignore_index=True)
+    except Exception as e:
+        report_history_error(f"Could not read {kind} rows from the history store: {str(e)}")
+        return None
+
+def _read_workbook_sheet(data, name, sheet=None):
+    # Stream the workbook in read-only mode and hand the open book to pandas so
+    # only the requested sheet is materialized; header handling matches read_excel.
+    wb = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True, keep_links=False)
+    try:
+        if sheet and sheet not in wb.sheetnames:
+            error_msg = f"Sheet '{sheet}' not found in {name}. Available sheets: {', '.join(wb.sheetnames)}"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        return pd.read_excel(wb, sheet_name=sheet if sheet else 0, engine='openpyxl')
+    finally:
+        wb.close()
+
 def read_file(file, sheet=None):
     try:
         start_time = time.time()
         logger.info(f"Reading file {file.name} with size {file.size / 1024:.2f} KB")
         ext = os.path.splitext(file.name)[1].lower()
-        if file.size > 10_000_000:  # 10 MB limit
-            error_msg = f"File {file.name} is too large (>10MB). Please upload a smaller file."
+        if ext not in ['.xlsx', '.xls', '.csv']:
+            error_msg = f"Invalid file format for {file.name}. Please upload CSV or Excel files."
             logger.error(error_msg)
             raise ValueError(error_msg)
+        data = file.getvalue()
+        # Parsed sheets are cached by content hash so reruns skip the parse entirely
+        cache = st.session_state.setdefault('file_cache', {})
+        cache_key = (file_digest(file), sheet)
+        if cache_key in cache:
+            logger.info(f"Using cached parse of {file.name} (sheet: {sheet})")
+            return cache[cache_key].copy()
         if ext in ['.xlsx', '.xls']:
-            df = pd.read_excel(file, sheet_name=sheet if sheet else 0, engine='openpyxl')
-        elif ext == '.csv':
-            df = pd.read_csv(file)
+            df = _read_workbook_sheet(data, file.name, sheet)
         else:
-            error_msg = f"Invalid file format for {file.name}. Please upload CSV or Excel files."
-            logger.error(error_msg)
-            raise ValueError(error_msg)
+            df = pd.read_csv(BytesIO(data))
+        cache[cache_key] = df
+        while len(cache) > FILE_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
         logger.info(f"Successfully read {file.name} in {time.time() - start_time:.2f} seconds")
-        return df
+        return df.copy()
     except Exception as e:
         error_msg = f"Error reading file {file.name}: {str(e)}"
         logger.error(error_msg)
         raise
 
-def process_files(file1, file2, file3, sheet_name, date_input):
-    try:
-        start_time = time.time()
-        logger.info("Starting file processing")
-
-        # Read files
-        progress_bar = st.progress(0)
-        with st.spinner("Reading files..."):
-            logger.info("Progress: 10% - Reading files")
-            progress_bar.progress(10)
-            df1 = read_file(file1)
-            df2 = read_file(file2, sheet='Record')
-            df3 = read_file(file3, sheet=sheet_name)
-
-        # Validate DataFrames
-        for df, name in [(df1, 'file1'), (df2, 'file2'), (df3, 'file3')]:
-            if not isinstance(df, pd.DataFrame):
-                error_msg = f"Error: {name} did not load as a DataFrame. Got type {type(df)}."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            if df.empty:
-                error_msg = f"File {name} is empty."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-
-        logger.info("Progress: 20% - Files validated")
-        progress_bar.progress(20)
-
-        # Process df3 sections
-        with st.spinner("Processing file3 sections..."):
-            try:
-                logger.info("Extracting sections from file3")
-                mtm_row_index = df3[df3["Unnamed: 0"] == "MTM"].index[0]
-                capital_deployed_row_index = df3[df3["Unnamed: 0"] == "Capital Deployed"].index[0]
-                max_loss_row_index = df3[df3["Unnamed: 0"] == "Max SL"].index[0]
-                AVG_row_index = df3[df3["Unnamed: 0"] == "AVG %"].index[0]
-            except IndexError as e:
-                error_msg = f"Required sections (MTM, Capital Deployed, Max SL, AVG %) not found in file3. Details: {str(e)}"
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            except KeyError as e:
-                error_msg = f"'Unnamed: 0' column not found in file3. {str(e)}"
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-
-        logger.info("Progress: 30% - Sections extracted")
-        progress_bar.progress(30)
-
-        # Split df3 into sections
-        mtm_df = df3.iloc[mtm_row_index:capital_deployed_row_index + 1]
-        capital_deployed_df = df3.iloc[capital_deployed_row_index:max_loss_row_index + 1]
-        max_loss_df = df3.iloc[max_loss_row_index:AVG_row_index + 1]
-
-        # Process mtm_df
-        with st.spinner("Processing MTM section..."):
-            try:
-                logger.info("Processing MTM section")
-                mtm_df = mtm_df.drop(index=mtm_df.index[0]).reset_index(drop=True)
-                mtm_df.columns = mtm_df.iloc[0]
-                mtm_df = mtm_df.drop(index=0).reset_index(drop=True)
-                mtm_df = mtm_df[:-1]
-                if 'IDs' not in mtm_df.columns:
-                    error_msg = "Error: 'IDs' column not found in MTM section of file3."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-                non_null_ids = mtm_df['IDs'].dropna().tolist()
-                if not non_null_ids:
-                    error_msg = "Error: No valid IDs found in MTM section."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-            except Exception as e:
-                error_msg = f"Error processing MTM section: {str(e)}"
-                logger.error(error_msg)
-                raise
-
-        logger.info("Progress: 40% - MTM processed")
-        progress_bar.progress(40)
-
-        # Process capital_deployed_df
-        with st.spinner("Processing Capital Deployed section..."):
-            try:
-                logger.info("Processing Capital Deployed section")
-                capital_deployed_df = capital_deployed_df.drop(index=capital_deployed_df.index[0]).reset_index(drop=True)
-                capital_deployed_df.columns = capital_deployed_df.iloc[0]
-                capital_deployed_df = capital_deployed_df.drop(index=0).reset_index(drop=True)
-                capital_deployed_df = capital_deployed_df[:-1]
-                if 'IDs' not in capital_deployed_df.columns:
-                    error_msg = "Error: 'IDs' column not found in Capital Deployed section."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-            except Exception as e:
-                error_msg = f"Error processing Capital Deployed section: {str(e)}"
-                logger.error(error_msg)
-                raise
+# Marker labels in the first column of the JAINAM DAILY month sheet, in sheet
+# order. Each section runs up to the next marker; AVG % only closes Max SL.
+SECTION_MARKERS = ['MTM', 'Capital Deployed', 'Max SL', 'AVG %']
+
+def index_sections(markers, labels=SECTION_MARKERS):
+    """Scan the marker column once and return {label: (start, header, end)} row positions."""
+    values = markers.to_numpy()
+    positions = {}
+    for pos in np.flatnonzero(markers.isin(labels).to_numpy()):
+        positions.setdefault(values[pos], int(pos))
+    missing = [label for label in labels if label not in positions]
+    if missing:
+        error_msg = f"Required sections ({', '.join(labels)}) not found in file3. Missing: {', '.join(missing)}"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    sections = {}
+    for label, next_label in zip(labels, labels[1:]):
+        start, end = positions[label], positions[next_label]
+        if end <= start + 1:
+            error_msg = f"Section '{label}' in file3 has no header row before '{next_label}'."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        sections[label] = (start, start + 1, end)
+    return sections
+
+def section_frame(df, header, end):
+    """Return the rows between a section's header row and its end marker, headed and typed."""
+    frame = df.iloc[header + 1:end].reset_index(drop=True)
+    frame.columns = df.iloc[header].tolist()
+    return frame.infer_objects()
+
+# Component rows listed under every user in the output, in display order
+ALIAS_COMPONENTS = ['PS', 'VT', 'GB', 'RD', 'RM']
+
+def expand_alias_rows(df, aliases=ALIAS_COMPONENTS):
+    """Follow every user row with one blank row per component alias."""
+    block = len(aliases) + 1
+    expanded = df.reset_index(drop=True)
+    expanded.index = expanded.index * block
+    expanded = expanded.reindex(pd.RangeIndex(len(df) * block))
+    alias = np.tile(np.array([np.nan] + list(aliases), dtype=object), len(df))
+    if 'Alias' in expanded.columns:
+        alias[::block] = expanded['Alias'].iloc[::block].to_numpy()
+    expanded['Alias'] = alias
+    return expanded
+
+# Column layout of every dated block in the Record sheet of file2
+RECORD_HEADER = ['UserID', 'User Alias', 'Algo', 'VT', 'GB', 'PS', 'RD', 'RM', 'ALLOCATION', 'MAX LOSS']
+
+def _block_date(values):
+    """Return the first value in a Record date row that parses to a 2020+ date."""
+    for val in values:
+        try:
+            dt = pd.to_datetime(val, dayfirst=True, errors='raise')
+            if dt.year >= 2020:
+                return dt
+        except Exception:
+            continue
+    return pd.NaT
+
+def parse_record_blocks(df2, header=RECORD_HEADER):
+    """Slice every UserID block of the Record sheet into one frame with its block Date."""
+    text = df2.astype(str)
+    is_header = np.zeros(len(df2), dtype=bool)
+    for col in text.columns:
+        is_header |= text[col].str.contains("UserID", case=False, na=False).to_numpy()
+    header_rows = np.flatnonzero(is_header)
+    if not len(header_rows):
+        error_msg = "Error: 'UserID' column not found in file2 (Record sheet)."
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    if df2.shape[1] != len(header):
+        error_msg = f"Error: Record sheet in file2 has {df2.shape[1]} columns, expected {len(header)}."
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    # A block runs from its header row to the next header or fully blank row
+    stops = np.flatnonzero(is_header | df2.isnull().all(axis=1).to_numpy())
+    ends = np.append(stops, len(df2))[np.searchsorted(stops, header_rows, side='right')]
+    values = df2.to_numpy(dtype=object)
+    blocks, dates, lengths = [], [], []
+    for header_row, end in zip(header_rows, ends):
+        if end > header_row + 1:
+            blocks.append(values[header_row + 1:end])
+            dates.append(_block_date(values[header_row - 1]) if header_row > 0 else pd.NaT)
+            lengths.append(end - header_row - 1)
+    if not blocks:
+        error_msg = "Error: No valid data blocks found in file2."
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    records = pd.DataFrame(np.vstack(blocks), columns=header).infer_objects()
+    records["Date"] = pd.DatetimeIndex(dates).repeat(lengths)
+    return records
+
+def fill_component_allocations(capital_df, records, aliases=ALIAS_COMPONENTS, by=()):
+    """Set each component row's Allocation from its user's Record share, scaled to rupees.
+
+    by names extra key columns present in both frames, e.g. Date when days are stacked.
+    """
+    by = list(by)
+    owner = capital_df['IDs'].ffill()
+    is_component = (capital_df['IDs'].isna() & owner.notna() & (owner != '')
+                    & capital_df['Alias'].isin(aliases))
+    # (UserID, alias) -> share of the user's allocation, first Record row per user
+    shares = (records.drop_duplicates(subset=by + ['UserID'], keep='first')
+              .melt(id_vars=by + ['UserID'], value_vars=list(aliases), var_name='Alias', value_name='share')
+              .set_index(by + ['UserID', 'Alias'])['share'])
+    keys = pd.MultiIndex.from_arrays([capital_df.loc[is_component, col] for col in by]
+                                     + [owner[is_component], capital_df.loc[is_component, 'Alias']])
+    allocation = pd.to_numeric(shares.reindex(keys), errors='raise').to_numpy(dtype=float) * 10_000_000
+    found = ~np.isnan(allocation)
+    capital_df = capital_df.copy()
+    capital_df.loc[capital_df.index[is_component][found], 'Allocation'] = allocation[found]
+    return capital_df
+
+def allocate_component_mtm(df):
+    """Split each user's MTM across the component rows below it by allocation share."""
+    is_user = df['IDs'].notna()
+    owner = is_user.cumsum()
+    is_component = ~is_user & (owner > 0) & df['Allocation'].notna()
+    total_allocation = df['Allocation'].where(is_component).groupby(owner).transform('sum')
+    main_mtm = df['MTM'].where(is_user).groupby(owner).transform('first')
+    split = is_component & (total_allocation > 0) & main_mtm.notna()
+    proportion = df.loc[split, 'Allocation'] / total_allocation[split]
+    df = df.copy()
+    # Builtin round keeps the existing half-cent behaviour (np.round differs on binary ties)
+    df.loc[split, 'MTM'] = [round(value, 2) for value in main_mtm[split] * proportion]
+    return df
+
+def stage_weights(stages):
+    """Median seconds per stage over recent runs in STAGE_LOG; unseen stages get the overall median."""
+    history = {stage: [] for stage in stages}
+    if os.path.exists(STAGE_LOG):
+        try:
+            with open(STAGE_LOG) as f:
+                for line in deque(f, maxlen=STAGE_HISTORY_LINES):
+                    record = json.loads(line)
+                    if record.get('stage') in history:
+                        history[record['stage']].append(record['seconds'])
+        except Exception as e:
+            logger.warning(f"Could not read stage metrics: {str(e)}")
+    known = [float(np.median(seconds)) for seconds in history.values() if seconds]
+    default = float(np.median(known)) if known else 1.0
+    return {stage: max(float(np.median(seconds)) if seconds else default, 1e-3) for stage, seconds in history.items()}
+
+class StageTimer:
+    """Lap timer over pipeline stages that drives the progress bar from past stage costs."""
+
+    def __init__(self, stages, progress=None, **context):
+        self.progress = progress
+        self.context = context
+        self.records = []
+        self.last = time.time()
+        self.weights = stage_weights(stages) if progress else {}
+        self.total = sum(self.weights.values())
+        self.done = 0.0
+
+    def lap(self, stage, rows=None):
+        """Close the stage that ran since the previous lap and advance the progress bar."""
+        now = time.time()
+        seconds, self.last = now - self.last, now
+        self.records.append({'stage': stage, 'seconds': round(seconds, 4), 'rows': rows})
+        logger.info(f"Stage '{stage}' finished in {seconds:.3f} seconds ({rows if rows is not None else '-'} rows)")
+        self.done += self.weights.get(stage, 0.0)
+        self._report(self.done)
+
+    def partial(self, stage, fraction):
+        """Report progress part-way through a long stage without closing it."""
+        self._report(self.done + fraction * self.weights.get(stage, 0.0))
+
+    def _report(self, done):
+        if self.progress and self.total:
+            self.progress(min(99, int(100 * done / self.total)))
+
+    def save(self):
+        """Append this run's stage metrics to STAGE_LOG and return them as a frame."""
+        try:
+            run_at = datetime.now().isoformat(timespec='seconds')
+            with open(STAGE_LOG, 'a') as f:
+                for record in self.records:
+                    f.write(json.dumps({'run_at': run_at, **self.context, **record}) + '\n')
+        except Exception as e:
+            logger.warning(f"Could not write stage metrics: {str(e)}")
+        return pd.DataFrame(self.records)
+
+def load_inputs(file1, file2, file3, sheet_name, timer=None, days=None):
+    """Read and parse the three workbooks into the date-independent inputs of a run.
+
+    When days are given, file1 and file2 are served from the history store if
+    those exact files were ingested before; otherwise they are read and ingested.
+    """
+    timer = timer or StageTimer(LOAD_STAGES)
+    # Read files
+    with st.spinner("Reading files..."):
+        logger.info("Reading files")
+        digest1, digest2 = file_digest(file1), file_digest(file2)
+        # A stored file1 is read once the MTM IDs are known, for those users only
+        df1_from_history = days is not None and history_stamp('compiled_mtm', digest1) is not None
+        df1 = None if df1_from_history else read_file(file1)
+        records = history_slice('record', digest2, days)
+        df2 = read_file(file2, sheet='Record') if records is None else records
+        df3 = read_file(file3, sheet=sheet_name)
+    timer.lap('Read files', rows=sum(len(df) for df in (df1, df2, df3) if df is not None))
+
+    # Validate DataFrames
+    for df, name in [(df1, 'file1'), (df2, 'file2'), (df3, 'file3')]:
+        if name == 'file1' and df1_from_history:
+            continue
+        if not isinstance(df, pd.DataFrame):
+            error_msg = f"Error: {name} did not load as a DataFrame. Got type {type(df)}."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        if df.empty:
+            error_msg = f"File {name} is empty."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
 
-        logger.info("Progress: 50% - Capital Deployed processed")
-        progress_bar.progress(50)
+    timer.lap('Validate files')
 
-        # Process max_loss_df
-        with st.spinner("Processing Max SL section..."):
-            try:
-                logger.info("Processing Max SL section")
-                max_loss_df = max_loss_df.drop(index=max_loss_df.index[0]).reset_index(drop=True)
-                max_loss_df.columns = max_loss_df.iloc[0]
-                max_loss_df = max_loss_df.drop(index=0).reset_index(drop=True)
-                max_loss_df = max_loss_df[:-1]
-                if 'IDs' not in max_loss_df.columns:
-                    error_msg = "Error: 'IDs' column not found in Max SL section."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-            except Exception as e:
-                error_msg = f"Error processing Max SL section: {str(e)}"
-                logger.error(error_msg)
-                raise
+    # Process df3 sections
+    with st.spinner("Processing file3 sections..."):
+        try:
+            logger.info("Extracting sections from file3")
+            sections = index_sections(df3["Unnamed: 0"])
+        except KeyError as e:
+            error_msg = f"'Unnamed: 0' column not found in file3. {str(e)}"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
 
-        logger.info("Progress: 60% - Max SL processed")
-        progress_bar.progress(60)
+    timer.lap('Index sections', rows=len(df3))
 
-        # Filter df1 by IDs
-        with st.spinner("Filtering file1 by IDs..."):
+    # Build one frame per section straight from its boundaries
+    section_frames = {}
+    for label in ['MTM', 'Capital Deployed', 'Max SL']:
+        with st.spinner(f"Processing {label} section..."):
             try:
-                logger.info("Filtering df1 by IDs")
-                if 'UserID' not in df1.columns:
-                    error_msg = "Error: 'UserID' column not found in file1."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-                df_new = df1[df1["UserID"].isin(non_null_ids)]
-                if df_new.empty:
-                    error_msg = "No matching UserIDs found in file1."
+                logger.info(f"Processing {label} section")
+                section_frames[label] = section_frame(df3, *sections[label][1:])
+                if 'IDs' not in section_frames[label].columns:
+                    error_msg = f"Error: 'IDs' column not found in {label} section of file3."
                     logger.error(error_msg)
                     raise ValueError(error_msg)
-                df_new['Date'] = pd.to_datetime(df_new['Date'])
             except Exception as e:
-                error_msg = f"Error filtering or converting Date in file1: {str(e)}"
+                error_msg = f"Error processing {label} section: {str(e)}"
                 logger.error(error_msg)
                 raise
+        timer.lap(f'{label} section', rows=len(section_frames[label]))
+    mtm_df = section_frames['MTM']
+    capital_deployed_df = section_frames['Capital Deployed']
+    max_loss_df = section_frames['Max SL']
+
+    non_null_ids = mtm_df['IDs'].dropna().tolist()
+    if not non_null_ids:
+        error_msg = "Error: No valid IDs found in MTM section."
+        logger.error(error_msg)
+        raise ValueError(error_msg)
 
-        # Filter by date
-        try:
-            logger.info("Filtering df1 by date")
-            match_date = pd.to_datetime(date_input)
-            matched_rows = df_new[df_new['Date'].dt.date == match_date.date()]
-            if matched_rows.empty:
-                error_msg = f"No data found for date {date_input} in file1."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-        except Exception as e:
-            error_msg = f"Error filtering by date: {str(e)}"
-            logger.error(error_msg)
-            raise
-
-        logger.info("Progress: 70% - Date filtered")
-        progress_bar.progress(70)
-
-        # Drop unnecessary columns
-        try:
-            logger.info("Dropping unnecessary columns")
-            cols_to_drop = ['Date', 'SNO', 'Enabled', 'LoggedIn', 'SqOff Done',
-                            'Broker', 'Qty Multiplier', 'Available Margin', 'Total Orders',
-                            'Total Lots', 'SERVER', 'Unnamed: 16', 'Unnamed: 17',
-                            'Unnamed: 18', 'Unnamed: 19', 'Unnamed: 20']
-            matched_rows = matched_rows.drop(columns=[col for col in cols_to_drop if col in matched_rows.columns])
-        except Exception as e:
-            error_msg = f"Error dropping columns: {str(e)}"
-            logger.error(error_msg)
-            raise
-
-        # Map values and ensure numeric conversion
+    # Filter df1 by IDs
+    with st.spinner("Filtering file1 by IDs..."):
         try:
-            logger.info("Mapping values to dataframes")
-            if 'MTM (All)' not in matched_rows.columns:
-                error_msg = "Error: 'MTM (All)' column not found in file1."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            # Convert 'MTM (All)' to numeric, handling errors
-            matched_rows['MTM (All)'] = pd.to_numeric(matched_rows['MTM (All)'], errors='coerce')
-            if matched_rows['MTM (All)'].isna().any():
-                error_msg = "Error: Non-numeric values found in 'MTM (All)' column of file1."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            # Validate IDs mapping for MTM
-            unmatched_ids_mtm = set(mtm_df['IDs'].dropna()) - set(matched_rows['UserID'])
-            if unmatched_ids_mtm:
-                logger.warning(f"IDs in file3 (MTM section) not found in file1: {unmatched_ids_mtm}")
-            mtm_df['mtm'] = mtm_df['IDs'].map(matched_rows.set_index('UserID')['MTM (All)'])
-
-            if 'ALLOCATION' not in matched_rows.columns:
-                error_msg = "Error: 'ALLOCATION' column not found in file1."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            # Convert 'ALLOCATION' to numeric
-            matched_rows['ALLOCATION'] = pd.to_numeric(matched_rows['ALLOCATION'], errors='coerce')
-            if matched_rows['ALLOCATION'].isna().any():
-                error_msg = "Error: Non-numeric values found in 'ALLOCATION' column of file1."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            capital_deployed_df['Allocation'] = (capital_deployed_df['IDs'].map(matched_rows.set_index('UserID')['ALLOCATION']) * 100)
-
-            if 'MAX LOSS' not in matched_rows.columns:
-                error_msg = "Error: 'MAX LOSS' column not found in file1."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            # Convert 'MAX LOSS' to numeric
-            matched_rows['MAX LOSS'] = pd.to_numeric(matched_rows['MAX LOSS'], errors='coerce')
-            if matched_rows['MAX LOSS'].isna().any():
-                error_msg = "Error: Non-numeric values found in 'MAX LOSS' column of file1."
+            logger.info("Filtering df1 by IDs")
+            if df1_from_history:
+                df1 = history_slice('compiled_mtm', digest1, days, users=non_null_ids)
+                if df1 is None:
+                    df1_from_history = False
+                    df1 = read_file(file1)
+            if 'UserID' not in df1.columns:
+                error_msg = "Error: 'UserID' column not found in file1."
                 logger.error(error_msg)
                 raise ValueError(error_msg)
-            # Validate IDs mapping for max_loss
-            unmatched_ids_max_loss = set(max_loss_df['IDs'].dropna()) - set(matched_rows['UserID'])
-            if unmatched_ids_max_loss:
-                logger.warning(f"IDs in file3 (Max SL section) not found in file1: {unmatched_ids_max_loss}")
-            max_loss_df['max_loss'] = max_loss_df['IDs'].map(matched_rows.set_index('UserID')['MAX LOSS'])
-        except Exception as e:
-            error_msg = f"Error mapping values: {str(e)}"
-            logger.error(error_msg)
-            raise
-
-        logger.info("Progress: 80% - Values mapped")
-        progress_bar.progress(80)
-
-        # Filter invalid rows
-        try:
-            logger.info("Filtering invalid rows")
-            mtm_df = mtm_df[mtm_df['IDs'].notna() & (mtm_df['IDs'] != '')]
-            capital_deployed_df = capital_deployed_df[capital_deployed_df['IDs'].notna() & (capital_deployed_df['IDs'] != '')]
-            max_loss_df = max_loss_df[max_loss_df['IDs'].notna() & (max_loss_df['IDs'] != '')]
-            if mtm_df.empty or capital_deployed_df.empty or max_loss_df.empty:
-                error_msg = "No valid rows after filtering."
+            df1['Date'] = pd.to_datetime(df1['Date'])
+            if not df1_from_history:
+                ingest_history('compiled_mtm', digest1, df1, sort_by='UserID')
+            df_new = df1[df1["UserID"].isin(non_null_ids)]
+            if df_new.empty:
+                error_msg = "No matching UserIDs found in file1."
                 logger.error(error_msg)
                 raise ValueError(error_msg)
         except Exception as e:
-            error_msg = f"Error filtering invalid rows: {str(e)}"
+            error_msg = f"Error filtering or converting Date in file1: {str(e)}"
             logger.error(error_msg)
             raise
 
-        # Expand mtm_df with alias rows
-        try:
-            logger.info("Expanding mtm_df with alias rows")
-            alias_values = ['PS', 'VT', 'GB', 'RD', 'RM']
-            new_rows = []
-            for _, row in mtm_df.iterrows():
-                new_rows.append(row.to_dict())
-                for alias in alias_values:
-                    empty_row = {col: np.nan for col in mtm_df.columns}
-                    empty_row['Alias'] = alias
-                    new_rows.append(empty_row)
-            mtm_df = pd.DataFrame(new_rows).reset_index(drop=True)
-        except Exception as e:
-            error_msg = f"Error expanding mtm_df: {str(e)}"
-            logger.error(error_msg)
-            raise
+    timer.lap('Filter file1 by IDs', rows=len(df_new))
 
-        # Expand capital_deployed_df
+    # Parse every dated block of the Record sheet
+    with st.spinner("Processing file2..."):
         try:
-            logger.info("Expanding capital_deployed_df")
-            new_rows = []
-            for _, row in capital_deployed_df.iterrows():
-                new_rows.append(row.to_dict())
-                for alias in alias_values:
-                    empty_row = {col: np.nan for col in capital_deployed_df.columns}
-                    empty_row['Alias'] = alias
-                    new_rows.append(empty_row)
-            capital_deployed_df = pd.DataFrame(new_rows).reset_index(drop=True)
-        except Exception as e:
-            error_msg = f"Error expanding capital_deployed_df: {str(e)}"
-            logger.error(error_msg)
-            raise
-
-        # Expand max_loss_df
-        try:
-            logger.info("Expanding max_loss_df")
-            new_rows = []
-            for _, row in max_loss_df.iterrows():
-                new_rows.append(row.to_dict())
-                for alias in alias_values:
-                    empty_row = {col: np.nan for col in max_loss_df.columns}
-                    empty_row['Alias'] = alias
-                    new_rows.append(empty_row)
-            max_loss_df = pd.DataFrame(new_rows).reset_index(drop=True)
-        except Exception as e:
-            error_msg = f"Error expanding max_loss_df: {str(e)}"
-            logger.error(error_msg)
-            raise
-
-        logger.info("Progress: 90% - DataFrames expanded")
-        progress_bar.progress(90)
-
-        # Process df2
-        with st.spinner("Processing file2..."):
-            try:
+            if records is None:
                 logger.info("Processing df2")
-                custom_header = ['UserID', 'User Alias', 'Algo', 'VT', 'GB', 'PS', 'RD', 'RM', 'ALLOCATION', 'MAX LOSS']
-                all_data = []
-                i = 0
-                user_id_found = False
-                while i < len(df2):
-                    row = df2.iloc[i]
-                    try:
-                        if row.astype(str).str.contains("UserID", case=False, na=False).any():
-                            user_id_found = True
-                            header_row_idx = i
-                            data_start_idx = i + 1
-                            date_val = None
-                            if header_row_idx > 0:
-                                date_row = df2.iloc[header_row_idx - 1]
-                                for val in date_row:
-                                    try:
-                                        dt = pd.to_datetime(val, dayfirst=True, errors='raise')
-                                        if dt.year >= 2020:
-                                            date_val = dt
-                                            break
-                                    except:
-                                        continue
-                            if date_val is None:
-                                date_val = pd.NaT
-                            data_rows = []
-                            j = data_start_idx
-                            while j < len(df2):
-                                row_j = df2.iloc[j]
-                                if row_j.isnull().all() or row_j.astype(str).str.contains("UserID", case=False, na=False).any():
-                                    break
-                                data_rows.append(row_j.tolist())
-                                j += 1
-                            if data_rows:
-                                block_df = pd.DataFrame(data_rows, columns=custom_header)
-                                block_df["Date"] = date_val
-                                all_data.append(block_df)
-                            i = j
-                        else:
-                            i += 1
-                    except Exception as inner_e:
-                        error_msg = f"Error processing df2 at row {i}: {str(inner_e)}"
-                        logger.error(error_msg)
-                        raise ValueError(error_msg)
-                if not user_id_found:
-                    error_msg = "Error: 'UserID' column not found in file2 (Record sheet)."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-                if not all_data:
-                    error_msg = "Error: No valid data blocks found in file2."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-                df2 = pd.concat(all_data, ignore_index=True)
+                df2 = parse_record_blocks(df2)
                 df2 = df2.drop(columns=['Algo', 'MAX LOSS'])
                 # Convert component columns to numeric, log non-numeric values
                 component_cols = ['VT', 'GB', 'PS', 'RD', 'RM']
@@ -419,211 +481,403 @@ def process_files(file1, file2, file3, sheet_name, date_input):
                         logger.warning(f"Non-numeric values in '{col}' column of file2: {non_numeric_values}")
                         # Replace NaN with 0 to continue processing
                         df2[col] = df2[col].fillna(0)
-                target_date = pd.to_datetime(date_input).normalize()
-                df2 = df2[df2['Date'] == target_date]
-                if df2.empty:
-                    error_msg = f"No data found for {target_date.date()} in file2."
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-                df2 = df2.iloc[:-1].reset_index(drop=True)
-            except Exception as e:
-                error_msg = f"Error processing df2: {str(e)}"
-                logger.error(error_msg)
-                raise
-
-        # Fill component allocations
-        try:
-            logger.info("Filling component allocations")
-            component_cols = ['PS', 'VT', 'GB', 'RD', 'RM']
-            current_userid = None
-            for i, row in capital_deployed_df.iterrows():
-                if pd.notna(row['IDs']):
-                    current_userid = row['IDs']
-                elif current_userid and row['Alias'] in component_cols:
-                    alias = row['Alias']
-                    matching_row = df2[df2['UserID'] == current_userid]
-                    if not matching_row.empty:
-                        value = matching_row.iloc[0][alias]
-                        capital_deployed_df.at[i, 'Allocation'] = float(value) * 10_000_000
+                ingest_history('record', digest2, df2)
         except Exception as e:
-            error_msg = f"Error filling component allocations: {str(e)}"
+            error_msg = f"Error processing df2: {str(e)}"
             logger.error(error_msg)
             raise
 
-        # Handle unnamed column
-        try:
-            logger.info("Handling unnamed column")
-            nan_column_name = capital_deployed_df.columns[capital_deployed_df.columns.isna()]
-            if not nan_column_name.empty:
-                nan_column_name = nan_column_name[0]
-                # Log non-numeric values in Allocation and unnamed column
-                original_allocation = capital_deployed_df['Allocation'].copy()
-                original_unnamed = capital_deployed_df[nan_column_name].copy()
-                capital_deployed_df['Allocation'] = pd.to_numeric(capital_deployed_df['Allocation'], errors='coerce')
-                if capital_deployed_df['Allocation'].isna().any():
-                    non_numeric_allocation = capital_deployed_df[original_allocation.notna() & capital_deployed_df['Allocation'].isna()]
-                    logger.warning(f"Non-numeric values in 'Allocation' column: {non_numeric_allocation[['IDs', 'Allocation']].to_dict('records')}")
-                # Convert unnamed column to numeric
-                capital_deployed_df[nan_column_name] = pd.to_numeric(capital_deployed_df[nan_column_name], errors='coerce')
-                if capital_deployed_df[nan_column_name].isna().any():
-                    non_numeric_unnamed = capital_deployed_df[original_unnamed.notna() & capital_deployed_df[nan_column_name].isna()]
-                    logger.warning(f"Non-numeric values in unnamed column '{nan_column_name}': {non_numeric_unnamed[['IDs', nan_column_name]].to_dict('records')}")
-                # Fill NaN in Allocation with unnamed column values
-                capital_deployed_df['Allocation'] = capital_deployed_df['Allocation'].fillna(capital_deployed_df[nan_column_name])
-                # Replace remaining NaN in Allocation with 0
-                capital_deployed_df['Allocation'] = capital_deployed_df['Allocation'].fillna(0)
-                capital_deployed_df = capital_deployed_df.drop(columns=[nan_column_name])
-            else:
-                # If no unnamed column, ensure Allocation is numeric
-                original_allocation = capital_deployed_df['Allocation'].copy()
-                capital_deployed_df['Allocation'] = pd.to_numeric(capital_deployed_df['Allocation'], errors='coerce')
-                if capital_deployed_df['Allocation'].isna().any():
-                    non_numeric_allocation = capital_deployed_df[original_allocation.notna() & capital_deployed_df['Allocation'].isna()]
-                    logger.warning(f"Non-numeric values in 'Allocation' column: {non_numeric_allocation[['IDs', 'Allocation']].to_dict('records')}")
-                    capital_deployed_df['Allocation'] = capital_deployed_df['Allocation'].fillna(0)
-        except Exception as e:
-            error_msg = f"Error handling unnamed column: {str(e)}"
+    timer.lap('Parse Record sheet', rows=len(df2))
+
+    return {
+        'mtm': mtm_df,
+        'capital_deployed': capital_deployed_df,
+        'max_loss': max_loss_df,
+        'mtm_rows': df_new,
+        'records': df2,
+    }
+
+def compute_day(inputs, date_input, timer=None):
+    """Build the Capital Deployed / MTM / Max SL output for one date from parsed inputs."""
+    timer = timer or StageTimer(DAY_STAGES)
+    mtm_df = inputs['mtm'].copy()
+    capital_deployed_df = inputs['capital_deployed'].copy()
+    max_loss_df = inputs['max_loss'].copy()
+    df_new = inputs['mtm_rows']
+    records = inputs['records']
+
+    # Filter by date
+    try:
+        logger.info("Filtering df1 by date")
+        match_date = pd.to_datetime(date_input)
+        matched_rows = df_new[df_new['Date'].dt.date == match_date.date()]
+        if matched_rows.empty:
+            error_msg = f"No data found for date {date_input} in file1."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+    except Exception as e:
+        error_msg = f"Error filtering by date: {str(e)}"
+        logger.error(error_msg)
+        raise
 
-        # Finalize mtm_df
-        try:
-            logger.info("Finalizing mtm_df")
-            mtm_df = mtm_df[["IDs", "Alias", "mtm"]]
-            original_mtm = mtm_df['mtm'].copy()
-            mtm_df['mtm'] = pd.to_numeric(mtm_df['mtm'], errors='coerce')
-            if mtm_df['mtm'].isna().any():
-                # Log rows with NaN in mtm
-                nan_mtm_rows = mtm_df[original_mtm.notna() & mtm_df['mtm'].isna()]
-                logger.warning(f"Non-numeric or missing values in 'mtm' column: {nan_mtm_rows[['IDs', 'Alias', 'mtm']].to_dict('records')}")
-                # Replace NaN with 0 to continue processing
-                mtm_df['mtm'] = mtm_df['mtm'].fillna(0)
-        except Exception as e:
-            error_msg = f"Error finalizing mtm_df: {str(e)}"
-            logger.error(error_msg)
-            raise
+    timer.lap('Filter by date', rows=len(matched_rows))
 
-        # Map MTM
-        try:
-            logger.info("Mapping MTM")
-            unique_mtm_df = mtm_df.drop_duplicates(subset='IDs', keep='first')
-            capital_deployed_df['MTM'] = capital_deployed_df['IDs'].map(unique_mtm_df.set_index('IDs')['mtm'])
-            capital_deployed_df['MTM'] = pd.to_numeric(capital_deployed_df['MTM'], errors='coerce')
-            if capital_deployed_df['MTM'].isna().any():
-                error_msg = "Error: Non-numeric values found in 'MTM' column after mapping."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-        except Exception as e:
-            error_msg = f"Error mapping MTM: {str(e)}"
+    # Drop unnecessary columns
+    try:
+        logger.info("Dropping unnecessary columns")
+        cols_to_drop = ['Date', 'SNO', 'Enabled', 'LoggedIn', 'SqOff Done',
+                        'Broker', 'Qty Multiplier', 'Available Margin', 'Total Orders',
+                        'Total Lots', 'SERVER', 'Unnamed: 16', 'Unnamed: 17',
+                        'Unnamed: 18', 'Unnamed: 19', 'Unnamed: 20']
+        matched_rows = matched_rows.drop(columns=[col for col in cols_to_drop if col in matched_rows.columns])
+    except Exception as e:
+        error_msg = f"Error dropping columns: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    # Map values and ensure numeric conversion
+    try:
+        logger.info("Mapping values to dataframes")
+        if 'MTM (All)' not in matched_rows.columns:
+            error_msg = "Error: 'MTM (All)' column not found in file1."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+        # Convert 'MTM (All)' to numeric, handling errors
+        matched_rows['MTM (All)'] = pd.to_numeric(matched_rows['MTM (All)'], errors='coerce')
+        if matched_rows['MTM (All)'].isna().any():
+            error_msg = "Error: Non-numeric values found in 'MTM (All)' column of file1."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        # Validate IDs mapping for MTM
+        unmatched_ids_mtm = set(mtm_df['IDs'].dropna()) - set(matched_rows['UserID'])
+        if unmatched_ids_mtm:
+            logger.warning(f"IDs in file3 (MTM section) not found in file1: {unmatched_ids_mtm}")
+        mtm_df['mtm'] = mtm_df['IDs'].map(matched_rows.set_index('UserID')['MTM (All)'])
+
+        if 'ALLOCATION' not in matched_rows.columns:
+            error_msg = "Error: 'ALLOCATION' column not found in file1."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        # Convert 'ALLOCATION' to numeric
+        matched_rows['ALLOCATION'] = pd.to_numeric(matched_rows['ALLOCATION'], errors='coerce')
+        if matched_rows['ALLOCATION'].isna().any():
+            error_msg = "Error: Non-numeric values found in 'ALLOCATION' column of file1."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        capital_deployed_df['Allocation'] = (capital_deployed_df['IDs'].map(matched_rows.set_index('UserID')['ALLOCATION']) * 100)
 
-        # Proportional MTM allocation
-        try:
-            logger.info("Applying proportional MTM allocation")
-            df = capital_deployed_df.copy()
-            df['Allocation'] = pd.to_numeric(df['Allocation'], errors='coerce')
-            df['MTM'] = pd.to_numeric(df['MTM'], errors='coerce')
-            if df['Allocation'].isna().any() or df['MTM'].isna().any():
-                error_msg = "Error: Non-numeric values found in 'Allocation' or 'MTM' columns."
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-            i = 0
-            while i < len(df):
-                if pd.notna(df.at[i, 'IDs']):
-                    main_mtm = float(df.at[i, 'MTM'])
-                    component_indices = []
-                    j = i + 1
-                    while j < len(df) and pd.isna(df.at[j, 'IDs']):
-                        if not pd.isna(df.at[j, 'Allocation']):
-                            component_indices.append(j)
-                        j += 1
-                    total_allocation = float(df.loc[component_indices, 'Allocation'].sum())
-                    if total_allocation > 0 and pd.notna(main_mtm):
-                        for idx in component_indices:
-                            allocation = float(df.at[idx, 'Allocation'])
-                            proportion = allocation / total_allocation
-                            df.at[idx, 'MTM'] = round(main_mtm * proportion, 2)
-                    i = j
-                else:
-                    i += 1
-            capital_deployed_df = df
-        except Exception as e:
-            error_msg = f"Error applying proportional MTM allocation: {str(e)}"
+        if 'MAX LOSS' not in matched_rows.columns:
+            error_msg = "Error: 'MAX LOSS' column not found in file1."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+        # Convert 'MAX LOSS' to numeric
+        matched_rows['MAX LOSS'] = pd.to_numeric(matched_rows['MAX LOSS'], errors='coerce')
+        if matched_rows['MAX LOSS'].isna().any():
+            error_msg = "Error: Non-numeric values found in 'MAX LOSS' column of file1."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        # Validate IDs mapping for max_loss
+        unmatched_ids_max_loss = set(max_loss_df['IDs'].dropna()) - set(matched_rows['UserID'])
+        if unmatched_ids_max_loss:
+            logger.warning(f"IDs in file3 (Max SL section) not found in file1: {unmatched_ids_max_loss}")
+        max_loss_df['max_loss'] = max_loss_df['IDs'].map(matched_rows.set_index('UserID')['MAX LOSS'])
+    except Exception as e:
+        error_msg = f"Error mapping values: {str(e)}"
+        logger.error(error_msg)
+        raise
 
-        # Combine with max_loss_df
-        try:
-            logger.info("Combining with max_loss_df")
-            original_max_loss = max_loss_df['max_loss'].copy()
-            max_loss_df['max_loss'] = pd.to_numeric(max_loss_df['max_loss'], errors='coerce')
-            if max_loss_df['max_loss'].isna().any():
-                # Log rows with NaN in max_loss
-                nan_max_loss_rows = max_loss_df[original_max_loss.notna() & max_loss_df['max_loss'].isna()]
-                logger.warning(f"Non-numeric or missing values in 'max_loss' column: {nan_max_loss_rows[['IDs', 'Alias', 'max_loss']].to_dict('records')}")
-                # Replace NaN with 0 to continue processing
-                max_loss_df['max_loss'] = max_loss_df['max_loss'].fillna(0)
-            capital_deployed_df["  "] = "|"
-            capital_deployed_df["IDs(1)"] = max_loss_df["IDs"]
-            capital_deployed_df["Alias(1)"] = max_loss_df["Alias"]
-            capital_deployed_df["max_loss"] = max_loss_df["max_loss"]
-        except Exception as e:
-            error_msg = f"Error combining with max_loss_df: {str(e)}"
+    timer.lap('Map values', rows=len(matched_rows))
+
+    # Filter invalid rows
+    try:
+        logger.info("Filtering invalid rows")
+        mtm_df = mtm_df[mtm_df['IDs'].notna() & (mtm_df['IDs'] != '')]
+        capital_deployed_df = capital_deployed_df[capital_deployed_df['IDs'].notna() & (capital_deployed_df['IDs'] != '')]
+        max_loss_df = max_loss_df[max_loss_df['IDs'].notna() & (max_loss_df['IDs'] != '')]
+        if mtm_df.empty or capital_deployed_df.empty or max_loss_df.empty:
+            error_msg = "No valid rows after filtering."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+    except Exception as e:
+        error_msg = f"Error filtering invalid rows: {str(e)}"
+        logger.error(error_msg)
+        raise
 
-        # Rename columns
-        try:
-            logger.info("Renaming columns")
-            capital_deployed_df = capital_deployed_df.rename(columns={
-                'IDs': 'User ID',
-                'Alias': 'Component',
-                'Allocation': 'Capital Deployed',
-                'MTM': 'MTM',
-                '  ': '|',
-                'IDs(1)': 'User ID (SL)',
-                'Alias(1)': 'Component (SL)',
-                'max_loss': 'Max Loss'
-            })
-        except Exception as e:
-            error_msg = f"Error renaming columns: {str(e)}"
+    # Expand every section with alias rows
+    try:
+        logger.info("Expanding sections with alias rows")
+        mtm_df = expand_alias_rows(mtm_df)
+        capital_deployed_df = expand_alias_rows(capital_deployed_df)
+        max_loss_df = expand_alias_rows(max_loss_df)
+    except Exception as e:
+        error_msg = f"Error expanding sections with alias rows: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    timer.lap('Expand alias rows', rows=len(capital_deployed_df))
+
+    # Select the Record rows of the requested date
+    try:
+        logger.info("Filtering df2 by date")
+        target_date = pd.to_datetime(date_input).normalize()
+        df2 = records[records['Date'] == target_date]
+        if df2.empty:
+            error_msg = f"No data found for {target_date.date()} in file2."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+        df2 = df2.iloc[:-1].reset_index(drop=True)
+    except Exception as e:
+        error_msg = f"Error processing df2: {str(e)}"
+        logger.error(error_msg)
+        raise
 
-        # Select only the required columns to avoid extra columns with NaN
-        try:
-            logger.info("Selecting required columns")
-            required_columns = ['User ID', 'Component', 'Capital Deployed', 'MTM', '|', 'User ID (SL)', 'Component (SL)', 'Max Loss']
-            capital_deployed_df = capital_deployed_df[required_columns]
-        except Exception as e:
-            error_msg = f"Error selecting required columns: {str(e)}"
+    timer.lap('Select Record date', rows=len(df2))
+
+    # Fill component allocations
+    try:
+        logger.info("Filling component allocations")
+        capital_deployed_df = fill_component_allocations(capital_deployed_df, df2)
+    except Exception as e:
+        error_msg = f"Error filling component allocations: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    timer.lap('Fill component allocations', rows=len(capital_deployed_df))
+
+    # Handle unnamed column
+    try:
+        logger.info("Handling unnamed column")
+        nan_column_name = capital_deployed_df.columns[capital_deployed_df.columns.isna()]
+        if not nan_column_name.empty:
+            nan_column_name = nan_column_name[0]
+            # Log non-numeric values in Allocation and unnamed column
+            original_allocation = capital_deployed_df['Allocation'].copy()
+            original_unnamed = capital_deployed_df[nan_column_name].copy()
+            capital_deployed_df['Allocation'] = pd.to_numeric(capital_deployed_df['Allocation'], errors='coerce')
+            if capital_deployed_df['Allocation'].isna().any():
+                non_numeric_allocation = capital_deployed_df[original_allocation.notna() & capital_deployed_df['Allocation'].isna()]
+                logger.warning(f"Non-numeric values in 'Allocation' column: {non_numeric_allocation[['IDs', 'Allocation']].to_dict('records')}")
+            # Convert unnamed column to numeric
+            capital_deployed_df[nan_column_name] = pd.to_numeric(capital_deployed_df[nan_column_name], errors='coerce')
+            if capital_deployed_df[nan_column_name].isna().any():
+                non_numeric_unnamed = capital_deployed_df[original_unnamed.notna() & capital_deployed_df[nan_column_name].isna()]
+                logger.warning(f"Non-numeric values in unnamed column '{nan_column_name}': {non_numeric_unnamed[['IDs', nan_column_name]].to_dict('records')}")
+            # Fill NaN in Allocation with unnamed column values
+            capital_deployed_df['Allocation'] = capital_deployed_df['Allocation'].fillna(capital_deployed_df[nan_column_name])
+            # Replace remaining NaN in Allocation with 0
+            capital_deployed_df['Allocation'] = capital_deployed_df['Allocation'].fillna(0)
+            capital_deployed_df = capital_deployed_df.drop(columns=[nan_column_name])
+        else:
+            # If no unnamed column, ensure Allocation is numeric
+            original_allocation = capital_deployed_df['Allocation'].copy()
+            capital_deployed_df['Allocation'] = pd.to_numeric(capital_deployed_df['Allocation'], errors='coerce')
+            if capital_deployed_df['Allocation'].isna().any():
+                non_numeric_allocation = capital_deployed_df[original_allocation.notna() & capital_deployed_df['Allocation'].isna()]
+                logger.warning(f"Non-numeric values in 'Allocation' column: {non_numeric_allocation[['IDs', 'Allocation']].to_dict('records')}")
+                capital_deployed_df['Allocation'] = capital_deployed_df['Allocation'].fillna(0)
+    except Exception as e:
+        error_msg = f"Error handling unnamed column: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    timer.lap('Handle unnamed column', rows=len(capital_deployed_df))
+
+    # Finalize mtm_df
+    try:
+        logger.info("Finalizing mtm_df")
+        mtm_df = mtm_df[["IDs", "Alias", "mtm"]]
+        original_mtm = mtm_df['mtm'].copy()
+        mtm_df['mtm'] = pd.to_numeric(mtm_df['mtm'], errors='coerce')
+        if mtm_df['mtm'].isna().any():
+            # Log rows with NaN in mtm
+            nan_mtm_rows = mtm_df[original_mtm.notna() & mtm_df['mtm'].isna()]
+            logger.warning(f"Non-numeric or missing values in 'mtm' column: {nan_mtm_rows[['IDs', 'Alias', 'mtm']].to_dict('records')}")
+            # Replace NaN with 0 to continue processing
+            mtm_df['mtm'] = mtm_df['mtm'].fillna(0)
+    except Exception as e:
+        error_msg = f"Error finalizing mtm_df: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    # Map MTM
+    try:
+        logger.info("Mapping MTM")
+        unique_mtm_df = mtm_df.drop_duplicates(subset='IDs', keep='first')
+        capital_deployed_df['MTM'] = capital_deployed_df['IDs'].map(unique_mtm_df.set_index('IDs')['mtm'])
+        capital_deployed_df['MTM'] = pd.to_numeric(capital_deployed_df['MTM'], errors='coerce')
+        if capital_deployed_df['MTM'].isna().any():
+            error_msg = "Error: Non-numeric values found in 'MTM' column after mapping."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+    except Exception as e:
+        error_msg = f"Error mapping MTM: {str(e)}"
+        logger.error(error_msg)
+        raise
 
-        # Clean NaN values for JSON compatibility
-        try:
-            logger.info("Cleaning NaN values in capital_deployed_df for JSON compatibility")
-            # Log rows with NaN values
-            nan_rows = capital_deployed_df[capital_deployed_df.isna().any(axis=1)]
-            if not nan_rows.empty:
-                logger.warning(f"Rows with NaN values in capital_deployed_df: {nan_rows.to_dict('records')}")
-            # Define column types
-            string_columns = ['User ID', 'Component', 'User ID (SL)', 'Component (SL)', '|']
-            numeric_columns = ['Capital Deployed', 'MTM', 'Max Loss']
-            # Replace NaN in string columns with empty string
-            for col in string_columns:
-                if col in capital_deployed_df.columns:
-                    capital_deployed_df[col] = capital_deployed_df[col].fillna('')
-            # Replace NaN in numeric columns with 0 (already handled, but ensure consistency)
-            for col in numeric_columns:
-                if col in capital_deployed_df.columns:
-                    capital_deployed_df[col] = pd.to_numeric(capital_deployed_df[col], errors='coerce').fillna(0)
-        except Exception as e:
-            error_msg = f"Error cleaning NaN values in capital_deployed_df: {str(e)}"
+    timer.lap('Map MTM', rows=len(capital_deployed_df))
+
+    # Proportional MTM allocation
+    try:
+        logger.info("Applying proportional MTM allocation")
+        df = capital_deployed_df.copy()
+        df['Allocation'] = pd.to_numeric(df['Allocation'], errors='coerce')
+        df['MTM'] = pd.to_numeric(df['MTM'], errors='coerce')
+        if df['Allocation'].isna().any() or df['MTM'].isna().any():
+            error_msg = "Error: Non-numeric values found in 'Allocation' or 'MTM' columns."
             logger.error(error_msg)
-            raise
+            raise ValueError(error_msg)
+        capital_deployed_df = allocate_component_mtm(df)
+    except Exception as e:
+        error_msg = f"Error applying proportional MTM allocation: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    timer.lap('Proportional MTM allocation', rows=len(capital_deployed_df))
+
+    # Combine with max_loss_df
+    try:
+        logger.info("Combining with max_loss_df")
+        original_max_loss = max_loss_df['max_loss'].copy()
+        max_loss_df['max_loss'] = pd.to_numeric(max_loss_df['max_loss'], errors='coerce')
+        if max_loss_df['max_loss'].isna().any():
+            # Log rows with NaN in max_loss
+            nan_max_loss_rows = max_loss_df[original_max_loss.notna() & max_loss_df['max_loss'].isna()]
+            logger.warning(f"Non-numeric or missing values in 'max_loss' column: {nan_max_loss_rows[['IDs', 'Alias', 'max_loss']].to_dict('records')}")
+            # Replace NaN with 0 to continue processing
+            max_loss_df['max_loss'] = max_loss_df['max_loss'].fillna(0)
+        capital_deployed_df["  "] = "|"
+        capital_deployed_df["IDs(1)"] = max_loss_df["IDs"]
+        capital_deployed_df["Alias(1)"] = max_loss_df["Alias"]
+        capital_deployed_df["max_loss"] = max_loss_df["max_loss"]
+    except Exception as e:
+        error_msg = f"Error combining with max_loss_df: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    # Rename columns
+    try:
+        logger.info("Renaming columns")
+        capital_deployed_df = capital_deployed_df.rename(columns={
+            'IDs': 'User ID',
+            'Alias': 'Component',
+            'Allocation': 'Capital Deployed',
+            'MTM': 'MTM',
+            '  ': '|',
+            'IDs(1)': 'User ID (SL)',
+            'Alias(1)': 'Component (SL)',
+            'max_loss': 'Max Loss'
+        })
+    except Exception as e:
+        error_msg = f"Error renaming columns: {str(e)}"
+        logger.error(error_msg)
+        raise
 
+    # Select only the required columns to avoid extra columns with NaN
+    try:
+        logger.info("Selecting required columns")
+        required_columns = ['User ID', 'Component', 'Capital Deployed', 'MTM', '|', 'User ID (SL)', 'Component (SL)', 'Max Loss']
+        capital_deployed_df = capital_deployed_df[required_columns]
+    except Exception as e:
+        error_msg = f"Error selecting required columns: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    # Clean NaN values for JSON compatibility
+    try:
+        logger.info("Cleaning NaN values in capital_deployed_df for JSON compatibility")
+        # Log rows with NaN values
+        nan_rows = capital_deployed_df[capital_deployed_df.isna().any(axis=1)]
+        if not nan_rows.empty:
+            logger.warning(f"Rows with NaN values in capital_deployed_df: {nan_rows.to_dict('records')}")
+        # Define column types
+        string_columns = ['User ID', 'Component', 'User ID (SL)', 'Component (SL)', '|']
+        numeric_columns = ['Capital Deployed', 'MTM', 'Max Loss']
+        # Replace NaN in string columns with empty string
+        for col in string_columns:
+            if col in capital_deployed_df.columns:
+                capital_deployed_df[col] = capital_deployed_df[col].fillna('')
+        # Replace NaN in numeric columns with 0 (already handled, but ensure consistency)
+        for col in numeric_columns:
+            if col in capital_deployed_df.columns:
+                capital_deployed_df[col] = pd.to_numeric(capital_deployed_df[col], errors='coerce').fillna(0)
+    except Exception as e:
+        error_msg = f"Error cleaning NaN values in capital_deployed_df: {str(e)}"
+        logger.error(error_msg)
+        raise
+
+    timer.lap('Combine and clean', rows=len(capital_deployed_df))
+    return capital_deployed_df
+
+def build_month_report(inputs, days):
+    """Split every day's MTM across components in one stacked pass and pivot users x days.
+
+    Returns {sheet name: frame} with the daily MTM pivot (plus MTD Total), the
+    running MTM pivot and each user's capital deployed against Max SL per day.
+    """
+    days = pd.DatetimeIndex(sorted({pd.Timestamp(day).normalize() for day in days}))
+    # Date-independent layout: valid user rows followed by their component rows
+    capital = inputs['capital_deployed']
+    layout = expand_alias_rows(capital[capital['IDs'].notna() & (capital['IDs'] != '')])
+    mtm_ids = set(inputs['mtm']['IDs'].dropna())
+    max_loss_ids = set(inputs['max_loss']['IDs'].dropna())
+
+    # file1 values per (Date, UserID), first row wins as in the daily mapping
+    daily = inputs['mtm_rows'].assign(Date=lambda df: df['Date'].dt.normalize())
+    daily = daily[daily['Date'].isin(days)].drop_duplicates(subset=['Date', 'UserID'], keep='first')
+    for col in ['MTM (All)', 'ALLOCATION', 'MAX LOSS']:
+        daily[col] = pd.to_numeric(daily[col], errors='coerce')
+    daily = daily.set_index(['Date', 'UserID'])
+
+    # Record rows per day without the trailing total row, as compute_day uses them
+    records = inputs['records'][inputs['records']['Date'].isin(days)]
+    records = records[records.groupby('Date').cumcount(ascending=False) > 0]
+
+    # Stack the layout once per day and fill every day in the same operations
+    n_rows = len(layout)
+    stacked = layout.iloc[np.tile(np.arange(n_rows), len(days))].reset_index(drop=True)
+    stacked['Date'] = days.repeat(n_rows)
+    values = daily.reindex(pd.MultiIndex.from_arrays([stacked['Date'], stacked['IDs']]))
+    stacked['Allocation'] = values['ALLOCATION'].to_numpy() * 100
+    stacked = fill_component_allocations(stacked, records, by=['Date'])
+    nan_column_name = stacked.columns[stacked.columns.isna()]
+    if not nan_column_name.empty:
+        fallback = pd.to_numeric(stacked[nan_column_name[0]], errors='coerce')
+        stacked['Allocation'] = pd.to_numeric(stacked['Allocation'], errors='coerce').fillna(fallback)
+    stacked['Allocation'] = pd.to_numeric(stacked['Allocation'], errors='coerce').fillna(0)
+    is_user = stacked['IDs'].notna().to_numpy()
+    user_mtm = np.where(stacked['IDs'].isin(mtm_ids), values['MTM (All)'].to_numpy(), np.nan)
+    stacked['MTM'] = np.where(is_user, np.nan_to_num(user_mtm), 0.0)
+    stacked = allocate_component_mtm(stacked)
+    stacked['Max Loss'] = np.nan_to_num(np.where(stacked['IDs'].isin(max_loss_ids), values['MAX LOSS'].to_numpy(), np.nan))
+
+    # One row per layout row, one column per day
+    labels = pd.DataFrame({'User ID': layout['IDs'].fillna(''), 'Component': layout['Alias'].fillna('')})
+    day_labels = [day.strftime('%Y-%m-%d') for day in days]
+    mtm_by_day = pd.DataFrame(stacked['MTM'].to_numpy().reshape(len(days), n_rows).T, columns=day_labels)
+    running_mtm = mtm_by_day.cumsum(axis=1).round(2)
+    mtm_by_day['MTD Total'] = running_mtm.iloc[:, -1]
+
+    users = stacked.loc[is_user, ['IDs', 'Date', 'Allocation', 'Max Loss', 'MTM']]
+    users['MTD MTM'] = users.groupby('IDs', sort=False)['MTM'].cumsum().round(2)
+    capital_vs_sl = (users.rename(columns={'IDs': 'User ID', 'Allocation': 'Capital Deployed'})
+                     .assign(Date=lambda df: df['Date'].dt.strftime('%Y-%m-%d'))
+                     .sort_values('User ID', kind='stable')
+                     .reset_index(drop=True))
+    return {
+        'MTM by Day': pd.concat([labels, mtm_by_day], axis=1),
+        'Running MTM': pd.concat([labels, running_mtm], axis=1),
+        'Capital vs Max SL': capital_vs_sl,
+    }
+
+def process_files(file1, file2, file3, sheet_name, date_input):
+    try:
+        start_time = time.time()
+        logger.info("Starting file processing")
+        progress_bar = st.progress(0)
+        timer = StageTimer(LOAD_STAGES + DAY_STAGES, progress_bar.progress, mode='single', sheet=sheet_name, date=str(date_input))
+        inputs = load_inputs(file1, file2, file3, sheet_name, timer, days=[date_input])
+        capital_deployed_df = compute_day(inputs, date_input, timer)
+        st.session_state.stage_metrics = timer.save()
         logger.info(f"Processing completed in {time.time() - start_time:.2f} seconds")
         progress_bar.progress(100)
         return capital_deployed_df
@@ -634,6 +888,78 @@ def process_files(file1, file2, file3, sheet_name, date_input):
     finally:
         progress_bar.empty()
 
+def process_date_range(file1, file2, file3, sheet_name, start_date, end_date, max_workers=4):
+    """Parse the workbooks once and build the daily output for every date in the range.
+
+    Returns ({date: output frame}, {date: error message}); dates missing from
+    file1 or the Record sheet are skipped without an error.
+    """
+    try:
+        start_time = time.time()
+        logger.info(f"Starting date range processing from {start_date} to {end_date}")
+        progress_bar = st.progress(0)
+        days = pd.date_range(start_date, end_date).date
+        timer = StageTimer(LOAD_STAGES + ['Compute dates'], progress_bar.progress, mode='range', sheet=sheet_name, date=f"{start_date}..{end_date}")
+        inputs = load_inputs(file1, file2, file3, sheet_name, timer, days=days)
+        available = set(inputs['mtm_rows']['Date'].dt.date) & set(inputs['records']['Date'].dropna().dt.date)
+        run_dates = [d for d in days if d in available]
+        if not run_dates:
+            error_msg = f"No dates between {start_date} and {end_date} found in both file1 and file2."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        logger.info(f"Processing {len(run_dates)} dates with {max_workers} workers")
+
+        # Days only read the shared parsed inputs, so they run on threads without copying them
+        results, failures = {}, {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(compute_day, inputs, day): day for day in run_dates}
+            for done, future in enumerate(as_completed(futures), start=1):
+                day = futures[future]
+                try:
+                    results[day] = future.result()
+                except Exception as e:
+                    failures[day] = str(e)
+                    logger.warning(f"Skipping {day} in date range: {str(e)}")
+                timer.partial('Compute dates', done / len(run_dates))
+        timer.lap('Compute dates', rows=len(run_dates))
+        st.session_state.stage_metrics = timer.save()
+        logger.info(f"Date range processed in {time.time() - start_time:.2f} seconds")
+        return {day: results[day] for day in sorted(results)}, failures
+    except Exception as e:
+        error_msg = f"Unexpected error in process_date_range: {str(e)}"
+        logger.error(error_msg)
+        raise
+    finally:
+        progress_bar.empty()
+
+def process_month_to_date(file1, file2, file3, sheet_name, end_date):
+    """Parse the workbooks once and build the month-to-date report up to end_date."""
+    try:
+        start_time = time.time()
+        month_start = pd.Timestamp(end_date).replace(day=1).date()
+        logger.info(f"Starting month-to-date report from {month_start} to {end_date}")
+        progress_bar = st.progress(0)
+        timer = StageTimer(LOAD_STAGES + ['Month report'], progress_bar.progress, mode='mtd', sheet=sheet_name, date=str(end_date))
+        days = pd.date_range(month_start, end_date).date
+        inputs = load_inputs(file1, file2, file3, sheet_name, timer, days=days)
+        available = set(inputs['mtm_rows']['Date'].dt.date) & set(inputs['records']['Date'].dropna().dt.date)
+        report_days = [d for d in days if d in available]
+        if not report_days:
+            error_msg = f"No dates between {month_start} and {end_date} found in both file1 and file2."
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        report = build_month_report(inputs, report_days)
+        timer.lap('Month report', rows=len(report_days))
+        st.session_state.stage_metrics = timer.save()
+        logger.info(f"Month-to-date report built in {time.time() - start_time:.2f} seconds")
+        return report
+    except Exception as e:
+        error_msg = f"Unexpected error in process_month_to_date: {str(e)}"
+        logger.error(error_msg)
+        raise
+    finally:
+        progress_bar.empty()
+
 def run():
     try:
         if 'error_logs' not in st.session_state:
@@ -651,11 +977,17 @@ def run():
         if 'theme' not in st.session_state:
             st.session_state.theme = 'light'
         if 'form_inputs' not in st.session_state:
-            st.session_state.form_inputs = {'file1': None, 'file2': None, 'file3': None, 'sheet_name': '', 'date': None}
+            st.session_state.form_inputs = {'file1': None, 'file2': None, 'file3': None, 'sheet_name': '', 'date': None, 'end_date': None}
         if 'logged_in' not in st.session_state:
             st.session_state.logged_in = False
         if 'output' not in st.session_state:
             st.session_state.output = None
+        if 'range_output' not in st.session_state:
+            st.session_state.range_output = None
+        if 'mtd_output' not in st.session_state:
+            st.session_state.mtd_output = None
+        if 'stage_metrics' not in st.session_state:
+            st.session_state.stage_metrics = None
 
         def get_css(theme):
             if theme == 'dark':
@@ -1091,6 +1423,29 @@ def run():
             if date_input:
                 st.session_state.form_inputs['date'] = date_input
 
+            run_mode = st.radio(
+                "Mode",
+                ["Single date", "Date range", "Month to date"],
+                horizontal=True,
+                key="run_mode",
+                help="Date range builds one sheet per date up to the end date; Month to date reports the selected date's month up to that date."
+            )
+            range_mode = run_mode == "Date range"
+            end_date = None
+            workers = 1
+            if range_mode:
+                st.markdown('<div class="tooltip">📅 End Date<span class="tooltiptext">Last date of the range (inclusive).</span></div>', unsafe_allow_html=True)
+                end_date = st.date_input(
+                    "Select End Date",
+                    max_value=date.today(),
+                    value=st.session_state.form_inputs.get('end_date'),
+                    label_visibility="collapsed",
+                    key="end_date"
+                )
+                if end_date:
+                    st.session_state.form_inputs['end_date'] = end_date
+                workers = st.number_input("Worker threads", min_value=1, max_value=max(1, os.cpu_count() or 1), value=min(4, os.cpu_count() or 1), step=1, key="range_workers")
+
         col1, spacer, col2 = st.columns([1, 3, 1])
         with col1:
             process_clicked = st.button("⚙️ Process Files", key="process_btn")
@@ -1100,8 +1455,10 @@ def run():
         if reset_clicked:
             try:
                 logger.info("Reset button clicked, clearing form inputs")
-                st.session_state.form_inputs = {'file1': None, 'file2': None, 'file3': None, 'sheet_name': '', 'date': None}
+                st.session_state.form_inputs = {'file1': None, 'file2': None, 'file3': None, 'sheet_name': '', 'date': None, 'end_date': None}
                 st.session_state.output = None
+                st.session_state.range_output = None
+                st.session_state.mtd_output = None
                 st.success("Form reset successfully.")
                 st.rerun()
             except Exception as e:
@@ -1120,10 +1477,35 @@ def run():
                     st.markdown(f'<div class="error-message">{error_msg}</div>', unsafe_allow_html=True)
                     return
 
-                # Run processing in the main thread
-                with st.spinner("Processing files, please wait..."):
-                    st.session_state.output = process_files(file1, file2, file3, sheet_name, date_input)
-                st.markdown('<div class="success-message">✅ Files processed successfully! View the data below.</div>', unsafe_allow_html=True)
+                if range_mode:
+                    if not end_date or end_date < date_input:
+                        error_msg = "End date must be on or after the selected date."
+                        logger.error(error_msg)
+                        st.session_state['error_logs'].append(f"{datetime.now()}: {error_msg}")
+                        st.markdown(f'<div class="error-message">{error_msg}</div>', unsafe_allow_html=True)
+                        return
+                    with st.spinner("Processing date range, please wait..."):
+                        frames, failures = process_date_range(file1, file2, file3, sheet_name, date_input, end_date, int(workers))
+                    # The workbook is built once here, not on every rerun of the preview
+                    excel = to_excel_sheets({day.strftime('%Y-%m-%d'): df for day, df in frames.items()}) if frames else None
+                    st.session_state.range_output = {'frames': frames, 'failures': failures, 'start': date_input, 'end': end_date, 'excel': excel}
+                    st.session_state.output = None
+                    st.session_state.mtd_output = None
+                    st.markdown(f'<div class="success-message">✅ Processed {len(frames)} dates successfully! View the data below.</div>', unsafe_allow_html=True)
+                elif run_mode == "Month to date":
+                    with st.spinner("Building month-to-date report, please wait..."):
+                        report = process_month_to_date(file1, file2, file3, sheet_name, date_input)
+                    st.session_state.mtd_output = {'frames': report, 'end': date_input, 'excel': to_excel_sheets(report)}
+                    st.session_state.output = None
+                    st.session_state.range_output = None
+                    st.markdown('<div class="success-message">✅ Month-to-date report built successfully! View the data below.</div>', unsafe_allow_html=True)
+                else:
+                    # Run processing in the main thread
+                    with st.spinner("Processing files, please wait..."):
+                        st.session_state.output = process_files(file1, file2, file3, sheet_name, date_input)
+                    st.session_state.range_output = None
+                    st.session_state.mtd_output = None
+                    st.markdown('<div class="success-message">✅ Files processed successfully! View the data below.</div>', unsafe_allow_html=True)
 
             except Exception as e:
                 error_msg = f"Unexpected error during file processing: {str(e)}"
@@ -1176,6 +1558,69 @@ def run():
                 st.session_state['error_logs'].append(f"{datetime.now()}: {error_msg}")
                 st.error(error_msg)
 
+        if st.session_state.range_output is not None:
+            try:
+                logger.info("Displaying date range output")
+                range_output = st.session_state.range_output
+                frames = range_output['frames']
+                st.subheader("Processed Date Range")
+                if range_output['failures']:
+                    st.warning("Skipped dates: " + "; ".join(f"{day}: {msg}" for day, msg in range_output['failures'].items()))
+                if frames:
+                    preview_day = st.selectbox("Preview date", list(frames), format_func=lambda day: day.strftime('%d %b %Y'), key="range_preview")
+                    st.dataframe(
+                        frames[preview_day].style.format({
+                            'Capital Deployed': '{:,.2f}',
+                            'MTM': '{:,.2f}',
+                            'Max Loss': '{:,.2f}'
+                        }),
+                        use_container_width=True,
+                        hide_index=True
+                    )
+                    filename = f"jainam_{range_output['start'].strftime('%Y-%m-%d')}_to_{range_output['end'].strftime('%Y-%m-%d')}.xlsx"
+                    st.download_button(
+                        "📥 Download Date Range",
+                        data=range_output['excel'],
+                        file_name=filename,
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                    )
+            except Exception as e:
+                error_msg = f"Error displaying date range output: {str(e)}"
+                logger.error(error_msg)
+                st.session_state['error_logs'].append(f"{datetime.now()}: {error_msg}")
+                st.error(error_msg)
+
+        if st.session_state.mtd_output is not None:
+            try:
+                logger.info("Displaying month-to-date report")
+                mtd_output = st.session_state.mtd_output
+                st.subheader(f"Month-to-Date Report (to {mtd_output['end'].strftime('%d %b %Y')})")
+                tabs = st.tabs(list(mtd_output['frames']))
+                for tab, (sheet, report_df) in zip(tabs, mtd_output['frames'].items()):
+                    with tab:
+                        numeric_columns = report_df.select_dtypes('number').columns
+                        st.dataframe(
+                            report_df.style.format({col: '{:,.2f}' for col in numeric_columns}),
+                            use_container_width=True,
+                            hide_index=True
+                        )
+                st.download_button(
+                    "📥 Download Month-to-Date Report",
+                    data=mtd_output['excel'],
+                    file_name=f"jainam_mtd_{mtd_output['end'].strftime('%Y-%m-%d')}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+            except Exception as e:
+                error_msg = f"Error displaying month-to-date report: {str(e)}"
+                logger.error(error_msg)
+                st.session_state['error_logs'].append(f"{datetime.now()}: {error_msg}")
+                st.error(error_msg)
+
+        if st.session_state.stage_metrics is not None:
+            with st.expander("⏱️ Stage Timings (last run)"):
+                st.dataframe(st.session_state.stage_metrics, use_container_width=True, hide_index=True)
+                st.caption(f"All runs are appended to {STAGE_LOG}.")
+
         st.markdown('<div class="footer">Jainam Data Processor v1.0 | Developed By Sahil</div>', unsafe_allow_html=True)
 
     except Exception as e: